@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of joy.py
+#
+#    joy.py is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    joy.py is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with joy.py.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+Parse throughput benchmark.
+
+  python parse_benchmark.py [megabytes]
+
+Generates a Joy program of about that size (default 4) and times the
+parser on it as a string, from a file and from an mmap, against the old
+re.Scanner parser as a baseline.
+'''
+from mmap import mmap, ACCESS_READ
+from random import Random
+from re import Scanner
+from sys import argv
+from tempfile import TemporaryFile
+from time import time
+
+from joy.parser import (
+  Symbol,
+  iter_expression,
+  read_expression,
+  text_to_expression,
+  )
+from joy.utils.stack import expression_to_string, list_to_stack
+
+
+def generate(size, seed=23):
+  '''Return a random Joy program of about size bytes.'''
+  rand = Random(seed)
+  words = 'dup swap pop [ [ ] ] + - * i dip map step genrec'.split()
+  parts = []
+  total = depth = 0
+  while total < size:
+    kind = rand.random()
+    if kind < 0.3:
+      part = str(rand.randint(-1000, 100000))
+    elif kind < 0.35:
+      part = repr(rand.random() * 100)
+    elif kind < 0.4:
+      part = '"%s"' % ('x' * rand.randint(0, 12),)
+    else:
+      part = rand.choice(words)
+      if part == '[':
+        depth += 1
+      elif part == ']':
+        if not depth:
+          continue
+        depth -= 1
+    parts.append(part)
+    total += len(part) + 1
+    if rand.random() < 0.05:
+      parts.append('\n')
+  parts.extend(']' * depth)
+  return ' '.join(parts)
+
+
+#
+# The old parser, for comparison.
+#
+
+def _old_parse(tokens):
+  frame = []
+  stack = []
+  for tok in tokens:
+    if tok == '[':
+      stack.append(frame)
+      frame = []
+      stack[-1].append(frame)
+    elif tok == ']':
+      frame = stack.pop()
+      frame[-1] = list_to_stack(frame[-1])
+    else:
+      frame.append(tok)
+  return list_to_stack(frame)
+
+
+_scanner = Scanner([
+  (r'-?\d+\.\d*', lambda scanner, token: float(token)),
+  (r'-?\d+', lambda scanner, token: int(token)),
+  (r'[•\w!@$%^&*()_+<>?|\/;:`~,.=-]+', lambda scanner, token: Symbol(token)),
+  (r'\[|\]', lambda scanner, token: token),
+  (r'"(?:[^"\\]|\\.)*"', lambda scanner, token: token[1:-1]),
+  (r"'(?:[^'\\]|\\.)*'", lambda scanner, token: token[1:-1]),
+  (r'\s+', None),
+  ])
+
+
+def old_text_to_expression(text):
+  tokens, rest = _scanner.scan(text)
+  return _old_parse(tokens)
+
+
+def timed(label, size, f, *args):
+  start = time()
+  result = f(*args)
+  elapsed = time() - start
+  print('%-28s %8.3f s %8.2f MB/s' % (label, elapsed, size / elapsed / 1e6))
+  return result
+
+
+def consume(terms):
+  for _ in terms:
+    pass
+
+
+def main(megabytes=4):
+  text = generate(int(megabytes * 1e6))
+  size = len(text)
+  print('%i bytes' % (size,))
+  expected = timed('re.Scanner (old)', size, old_text_to_expression, text)
+  result = timed('text_to_expression', size, text_to_expression, text)
+  assert expression_to_string(result) == expression_to_string(expected)
+  with TemporaryFile() as f:
+    f.write(text)
+    f.seek(0)
+    result = timed('read_expression (file)', size, read_expression, f)
+    assert expression_to_string(result) == expression_to_string(expected)
+    f.seek(0)
+    timed('iter_expression (file)', size, consume, iter_expression(f))
+    m = mmap(f.fileno(), 0, access=ACCESS_READ)
+    result = timed('read_expression (mmap)', size, read_expression, m)
+    assert expression_to_string(result) == expression_to_string(expected)
+    m.close()
+
+
+if __name__ == '__main__':
+  main(float(argv[1]) if len(argv) > 1 else 4)
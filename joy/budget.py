@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Budgets
+
+
+A plain joy() call runs until the expression is empty, which might be
+never.  A Budget puts limits on an evaluation: a number of steps, a
+wall-clock deadline, and the size (in cons cells) of the stack and of the
+pending expression.  It can also be cancelled from another thread.
+
+When a limit is hit budgeted_joy() stops *before* evaluating the next
+term and raises BudgetExceeded carrying the stack, expression and
+dictionary at that point.  Because all of the state of a Joy computation
+is in those, you can report them, or resume the work later by passing
+them back in with a fresh (or topped-up) Budget:
+
+  try:
+    stack, _, dictionary = budgeted_joy(stack, expression, D, Budget(10000))
+  except BudgetExceeded as err:
+    stack, expression, dictionary = err.stack, err.expression, err.dictionary
+
+Only the step limit is exact (but see below), the other limits are
+checked every check_every steps so that the inner loop stays cheap.
+
+Words that run quotes themselves (the native loops, memo...) do it with
+nested_joy(), which is joy() outside of budgeted_joy() and budgeted_joy()
+with the same Budget inside it, so their sub-evaluations are metered
+too.  Words that would run quotes where a Budget can't follow them (the
+vectorized loops, the worker processes of parallel.py) check
+active_budget() and use the library's versions instead.  When a limit is
+hit inside a sub-evaluation the BudgetExceeded raised carries the state
+of the outermost evaluation from just before the word, which is run
+again from the start if the evaluation is resumed.  The steps of the
+evaluations around a sub-evaluation are only added up at their checks,
+so with nesting the step limit can be passed by up to check_every steps.
+
+Exports:
+
+  Budget
+
+  BudgetExceeded
+
+  active_budget()
+
+  budgeted_joy(stack, expression, dictionary, budget, viewer=None)
+
+  nested_joy(stack, expression, dictionary)
+
+'''
+from threading import Event, local
+from time import time
+from .joy import joy
+from .parser import Symbol
+from .utils.vector import cell_id
+
+
+class BudgetExceeded(Exception):
+  '''
+  Raised when an evaluation runs out of budget.  The reason is one of
+  'steps', 'deadline', 'stack', 'expression' or 'cancelled'.
+  '''
+
+  def __init__(self, reason, stack, expression, dictionary):
+    Exception.__init__(self, 'Budget exceeded: %s' % (reason,))
+    self.reason = reason
+    self.stack = stack
+    self.expression = expression
+    self.dictionary = dictionary
+
+
+class Budget(object):
+  '''
+  Limits for one or more evaluations.  The steps used are accumulated
+  across all the evaluations that share the budget.  Any of the limits
+  can be None to mean unlimited.
+  '''
+
+  def __init__(
+    self,
+    max_steps=None,
+    timeout=None,
+    max_stack=None,
+    max_expression=None,
+    check_every=1000,
+    ):
+    self.max_steps = max_steps
+    self.deadline = None if timeout is None else time() + timeout
+    self.max_stack = max_stack
+    self.max_expression = max_expression
+    self.check_every = check_every
+    self.steps = 0
+    self._cancelled = Event()
+
+  def cancel(self):
+    '''Stop any evaluation using this budget at its next check.'''
+    self._cancelled.set()
+
+  @property
+  def cancelled(self):
+    return self._cancelled.is_set()
+
+  def steps_until_check(self):
+    '''
+    How many steps may be taken before the next call to check().
+    '''
+    n = self.check_every
+    if self.max_steps is not None:
+      n = min(n, self.max_steps - self.steps)
+    return n
+
+  def check(self, stack, expression, dictionary):
+    '''
+    Raise BudgetExceeded if any of the limits have been reached.
+    '''
+    reason = None
+    if self.max_steps is not None and self.steps >= self.max_steps:
+      reason = 'steps'
+    elif self._cancelled.is_set():
+      reason = 'cancelled'
+    elif self.deadline is not None and time() >= self.deadline:
+      reason = 'deadline'
+    elif not _fits(stack, self.max_stack):
+      reason = 'stack'
+    elif not _fits(expression, self.max_expression):
+      reason = 'expression'
+    if reason:
+      raise BudgetExceeded(reason, stack, expression, dictionary)
+
+
+def _fits(datastructure, limit):
+  '''
+  Return True if the datastructure has no more than limit cons cells.
+
+  Nested quotes count, shared structure is only counted once, and the
+  walk stops as soon as the limit is passed.
+  '''
+  if limit is None:
+    return True
+  seen = set()
+  to_do = [datastructure]
+  while to_do:
+    item = to_do.pop()
+    while item and isinstance(item, tuple) and cell_id(item) not in seen:
+      seen.add(cell_id(item))
+      if len(seen) > limit:
+        return False
+      head, item = item
+      if isinstance(head, tuple):
+        to_do.append(head)
+  return True
+
+
+# The Budget of the budgeted_joy() running in each thread.
+_active = local()
+
+
+def active_budget():
+  '''
+  Return the Budget of the budgeted_joy() running in this thread, or
+  None.
+  '''
+  return getattr(_active, 'budget', None)
+
+
+def nested_joy(stack, expression, dictionary):
+  '''
+  Evaluate the Joy expression on the stack like joy(), within the Budget
+  of the budgeted_joy() that is running the word calling this, if any.
+  '''
+  budget = getattr(_active, 'budget', None)
+  if budget is None:
+    return joy(stack, expression, dictionary)
+  return budgeted_joy(stack, expression, dictionary, budget)
+
+
+def budgeted_joy(stack, expression, dictionary, budget, viewer=None):
+  '''
+  Evaluate the Joy expression on the stack within the budget.
+  '''
+  budget.check(stack, expression, dictionary)
+  countdown = budget.steps_until_check()
+  taken = 0
+  outer, _active.budget = getattr(_active, 'budget', None), budget
+  try:
+    while expression:
+
+      if taken == countdown:
+        budget.steps += taken
+        taken = 0
+        budget.check(stack, expression, dictionary)
+        countdown = budget.steps_until_check()
+      taken += 1
+
+      if viewer: viewer(stack, expression)
+
+      term, expression = expression
+      if isinstance(term, Symbol):
+        F = dictionary[term]
+        try:
+          stack, expression, dictionary = F(stack, expression, dictionary)
+        except BudgetExceeded as err:  # In a nested_joy(), report ours.
+          raise BudgetExceeded(
+            err.reason, stack, (term, expression), dictionary)
+      else:
+        stack = term, stack
+
+  finally:
+    budget.steps += taken
+    _active.budget = outer
+
+  if viewer: viewer(stack, expression)
+  return stack, expression, dictionary
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Cooperative Evaluation
+
+
+joy() doesn't return until the expression is empty, and a word that
+waits for a file, a process or a socket makes everything in the thread
+wait with it.  coroutine_joy() is joy() as a generator: it yields every
+`every` steps, and at each word that has to wait (an AsyncWrapper) it
+yields what it's waiting for, so a Loop can run any number of Joy
+programs in one thread, switching between them while they compute and
+while they wait:
+
+  loop = Loop()
+  tasks = [
+    loop.spawn(coroutine_joy(stack, expression, dictionary))
+    for stack, expression in programs
+    ]
+  loop.run()
+  stack, expression, dictionary = tasks[0].get()
+
+For code without async words the steps are exactly those of joy().
+
+The protocol is the one generators have in Python 2 (there's no asyncio
+or "yield from".)  A coroutine yields one of
+
+  None              let the others run, then carry on
+  ('read', fd)      carry on once the file descriptor can be read
+  ('write', fd)     carry on once it can be written
+  ('sleep', secs)   carry on after that many seconds
+
+and finishes by raising Return(stack, expression, dictionary), or an
+error.  coroutine_joy() is one, and so is the function of every
+AsyncWrapper, which is given the stack, expression and dictionary like
+any other word's.  Called the usual way (e.g. by joy(), or inside the
+quote of a combinator that calls joy() itself) an AsyncWrapper runs its
+coroutine to the end in a Loop of its own, so async words work (but
+block) everywhere.  Inside budgeted_joy() (see budget.py) it doesn't
+wait past the Budget's deadline, and checks every BUDGET_POLL seconds
+whether the Budget has been cancelled; either way the coroutine is
+abandoned and BudgetExceeded raised.
+
+The async words here read files (a chunk at a time), the output of
+processes and the replies of sockets (Unix sockets and TCP):
+
+  ... "path" read_file
+  ... ["ls" "-l"] read_process
+  ... "path" "request" socket_request
+  ... ["localhost" 8000] "request" socket_request
+  ... seconds sleep
+
+  use_async(dictionary)  # Put them in the dictionary.
+
+Exports:
+
+  AsyncWrapper
+
+  BUDGET_POLL
+
+  CHUNK
+
+  Loop
+
+  Return(stack, expression, dictionary)
+
+  Task
+
+  async_words
+
+  coroutine_joy(stack, expression, dictionary, every=1000, viewer=None)
+
+  use_async(dictionary)
+
+'''
+from collections import deque
+from errno import EALREADY, EINPROGRESS, EISCONN, EWOULDBLOCK
+from heapq import heappop, heappush
+from itertools import count
+import os
+import select
+import socket
+from subprocess import CalledProcessError, PIPE, Popen
+import sys
+from time import sleep as _sleep, time
+from .budget import active_budget
+from .library import FunctionWrapper
+from .parser import Symbol
+from .utils.stack import iter_stack
+
+
+# The size of the reads of the async words.
+CHUNK = 65536
+
+# How often (in seconds) an async word blocking inside budgeted_joy()
+# checks its Budget.
+BUDGET_POLL = 0.05
+
+
+class Return(Exception):
+  '''Raised by a coroutine to finish with its result.'''
+
+  def __init__(self, *value):
+    Exception.__init__(self)
+    self.value = value
+
+
+class AsyncWrapper(FunctionWrapper):
+  '''
+  A word whose function is a coroutine (see above.)
+  '''
+
+  def __call__(self, stack, expression, dictionary):
+    loop = Loop()
+    task = loop.spawn(self.f(stack, expression, dictionary))
+    budget = active_budget()
+    if budget is None:
+      loop.run()
+      return task.get()
+    try:
+      while True:
+        timeout = BUDGET_POLL
+        if budget.deadline is not None:
+          timeout = max(0, min(timeout, budget.deadline - time()))
+        if loop.run(timeout):
+          break
+        budget.check(stack, (Symbol(self.name), expression), dictionary)
+    except BaseException:
+      task.coroutine.close()  # Abandon it.
+      raise
+    return task.get()
+
+
+def coroutine_joy(stack, expression, dictionary, every=1000, viewer=None):
+  '''
+  Evaluate the Joy expression on the stack like joy(), as a coroutine
+  that yields every so many steps and at words that wait.
+  '''
+  countdown = every
+  while expression:
+
+    if not countdown:
+      yield None
+      countdown = every
+    countdown -= 1
+
+    if viewer: viewer(stack, expression)
+
+    term, expression = expression
+    if isinstance(term, Symbol):
+      term = dictionary[term]
+      if isinstance(term, AsyncWrapper):
+        coroutine = term.f(stack, expression, dictionary)
+        try:
+          while True:
+            yield coroutine.next()
+        except Return as result:
+          stack, expression, dictionary = result.value
+      else:
+        stack, expression, dictionary = term(stack, expression, dictionary)
+    else:
+      stack = term, stack
+
+  if viewer: viewer(stack, expression)
+  raise Return(stack, expression, dictionary)
+
+
+#
+# § The Loop
+#
+
+
+class Task(object):
+  '''A coroutine being run by a Loop.'''
+
+  def __init__(self, coroutine):
+    self.coroutine = coroutine
+    self.done = False
+    self.value = None  # What it Returned.
+    self.exc_info = None  # Or what it raised.
+
+  def get(self):
+    '''
+    Return the value the coroutine returned (as a tuple) or raise what
+    it raised.
+    '''
+    if not self.done:
+      raise RuntimeError('The task has not finished.')
+    if self.exc_info:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.value
+
+
+class Loop(object):
+  '''Runs Tasks in turn until they're all done.'''
+
+  def __init__(self):
+    self.ready = deque()
+    self.sleeping = []  # A heap of (when, n, task.)
+    self.readers = {}  # fd -> the tasks waiting for it, in order.
+    self.writers = {}
+    self._count = count()
+
+  def spawn(self, coroutine):
+    '''Return a new Task running the coroutine.'''
+    task = Task(coroutine)
+    self.ready.append(task)
+    return task
+
+  def run(self, timeout=None):
+    '''
+    Run until every task is done, or for at most timeout seconds, and
+    return True if they're all done.
+    '''
+    until = None if timeout is None else time() + timeout
+    while self.ready or self.sleeping or self.readers or self.writers:
+      if until is not None and time() >= until:
+        return False
+      self._wake(until)
+      for _ in xrange(len(self.ready)):
+        self._step(self.ready.popleft())
+    return True
+
+  def _step(self, task):
+    try:
+      wait = task.coroutine.next()
+    except Return as result:
+      task.done, task.value = True, result.value
+      return
+    except Exception:
+      task.done, task.exc_info = True, sys.exc_info()
+      return
+    if wait is None:
+      self.ready.append(task)
+      return
+    kind, argument = wait
+    if kind == 'sleep':
+      when = time() + argument
+      heappush(self.sleeping, (when, next(self._count), task))
+    elif kind == 'read':
+      self.readers.setdefault(argument, []).append(task)
+    elif kind == 'write':
+      self.writers.setdefault(argument, []).append(task)
+    else:
+      task.done = True
+      error = ValueError('Unknown wait %r' % (wait,))
+      task.exc_info = ValueError, error, None
+
+  def _wake(self, until=None):
+    '''
+    Move the tasks that can carry on to ready, waiting (until then at
+    the latest) if there aren't any.
+    '''
+    timeout = None if not self.ready else 0
+    if self.sleeping:
+      delay = max(0, self.sleeping[0][0] - time())
+      timeout = delay if timeout is None else min(timeout, delay)
+    if until is not None:
+      delay = max(0, until - time())
+      timeout = delay if timeout is None else min(timeout, delay)
+    if self.readers or self.writers:
+      readable, writable, _ = select.select(
+        list(self.readers), list(self.writers), [], timeout)
+      for fd in readable:
+        self.ready.extend(self.readers.pop(fd))
+      for fd in writable:
+        self.ready.extend(self.writers.pop(fd))
+    elif timeout:
+      _sleep(timeout)
+    now = time()
+    while self.sleeping and self.sleeping[0][0] <= now:
+      self.ready.append(heappop(self.sleeping)[2])
+
+
+#
+# § Async Words
+#
+
+
+def read_file(stack, expression, dictionary):
+  '''
+  Read the file named on the top of the stack, letting the other
+  programs run between chunks.
+
+     ... "path" read_file
+  --------------------------
+        ... "contents"
+
+  '''
+  path, stack = stack
+  chunks = []
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      yield None
+  raise Return((''.join(chunks), stack), expression, dictionary)
+
+
+def read_process(stack, expression, dictionary):
+  '''
+  Run the command in the list of strings on the top of the stack and
+  push what it writes to stdout.  Raise CalledProcessError if it fails.
+
+     ... ["ls" "-l"] read_process
+  ----------------------------------
+            ... "output"
+
+  '''
+  args, stack = stack
+  args = list(iter_stack(args))
+  process = Popen(args, stdout=PIPE)
+  fd = process.stdout.fileno()
+  chunks = []
+  try:
+    while True:
+      yield 'read', fd
+      chunk = os.read(fd, CHUNK)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  except GeneratorExit:  # Abandoned, e.g. at a Budget's deadline.
+    process.kill()
+    raise
+  finally:
+    process.stdout.close()
+    status = process.wait()
+  output = ''.join(chunks)
+  if status:
+    raise CalledProcessError(status, args, output)
+  raise Return((output, stack), expression, dictionary)
+
+
+def socket_request(stack, expression, dictionary):
+  '''
+  Connect to the address (the path of a Unix socket, or a list of a
+  host and a port) send the request and push the reply, which is
+  everything read until the other end closes the connection.
+
+     ... address "request" socket_request
+  ------------------------------------------
+                ... "reply"
+
+  '''
+  request, (address, stack) = stack
+  if isinstance(address, tuple):
+    address = tuple(iter_stack(address))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  chunks = []
+  try:
+    sock.setblocking(0)
+    fd = sock.fileno()
+    while True:
+      error = sock.connect_ex(address)
+      if error in (0, EISCONN):
+        break
+      if error not in (EALREADY, EINPROGRESS, EWOULDBLOCK):
+        raise socket.error(error, os.strerror(error))
+      yield 'write', fd
+    sent = 0
+    while sent < len(request):
+      yield 'write', fd
+      sent += sock.send(request[sent:])
+    sock.shutdown(socket.SHUT_WR)
+    while True:
+      yield 'read', fd
+      chunk = sock.recv(CHUNK)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  finally:
+    sock.close()
+  raise Return((''.join(chunks), stack), expression, dictionary)
+
+
+def sleep(stack, expression, dictionary):
+  '''
+  Wait for the number of seconds on the top of the stack, letting the
+  other programs run.
+
+     ... seconds sleep
+  -----------------------
+            ...
+
+  '''
+  seconds, stack = stack
+  yield 'sleep', seconds
+  raise Return(stack, expression, dictionary)
+
+
+async_words = (
+  AsyncWrapper(read_file),
+  AsyncWrapper(read_process),
+  AsyncWrapper(sleep),
+  AsyncWrapper(socket_request),
+  )
+
+
+def use_async(dictionary):
+  '''Put the async words in the dictionary.'''
+  dictionary.update((F.name, F) for F in async_words)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Continuation Frames
+
+
+The combinators in the library run a quoted program by pushing it back
+onto the pending expression, which means copying the whole quote (see
+pushback()) every time.  The frame_joy() evaluator instead keeps the
+pending expression as a stack of frames:
+
+  (segment, (segment, (segment, ())))
+
+Each segment is the unevaluated tail of some quote, and the pending
+expression is their concatenation.  Because quotes are immutable cons
+lists, entering one is just pushing it as a new frame: O(1) and no
+copying.  Likewise a DefinitionWrapper pushes its body as a frame.
+
+Combinators that have a frame version (registered in FRAME_FUNCTIONS)
+are run that way.  Any other function is called as usual with the top
+segment as its expression, and whatever it returns replaces that
+segment, so every word in the dictionary still works.
+
+frame_joy() takes and returns the same things as joy().  If a viewer is
+given it's called with the flattened expression (which costs a copy at
+every step, so only use it for tracing.)
+
+Exports:
+
+  frame_joy(stack, expression, dictionary, viewer=None)
+
+  flatten(frames)
+
+'''
+from .library import (
+  BinaryBuiltinWrapper,
+  DefinitionWrapper,
+  FunctionWrapper,
+  SimpleFunctionWrapper,
+  UnaryBuiltinWrapper,
+  S_loop,
+  S_swaack,
+  S_times,
+  b,
+  branch,
+  dip,
+  dipd,
+  dipdd,
+  dupdip,
+  i,
+  infra,
+  loop,
+  times,
+  x,
+  )
+from .parser import Symbol
+from .utils.stack import iter_stack, list_to_stack
+
+
+def flatten(frames):
+  '''Return the pending expression represented by the frames.'''
+  terms = []
+  for segment in iter_stack(frames):
+    terms.extend(iter_stack(segment))
+  return list_to_stack(terms)
+
+
+def frame_joy(stack, expression, dictionary, viewer=None):
+  '''
+  Evaluate the Joy expression on the stack using continuation frames.
+  '''
+  frames = (expression, ()) if expression else ()
+  steps = 0  # Only for the sampler (see sampler.py) to read.
+  while frames:
+    steps += 1
+
+    if viewer: viewer(stack, flatten(frames))
+
+    segment, frames = frames
+    term, segment = segment
+    if segment:
+      frames = segment, frames
+
+    if not isinstance(term, Symbol):
+      stack = term, stack
+      continue
+
+    F = dictionary[term]
+    kind = F.__class__
+
+    if kind is SimpleFunctionWrapper:
+      stack = F.f(stack)
+
+    elif kind is DefinitionWrapper:
+      if F.body:
+        frames = F.body, frames
+
+    elif kind is BinaryBuiltinWrapper or kind is UnaryBuiltinWrapper:
+      stack, _, dictionary = F(stack, (), dictionary)
+
+    elif kind is FunctionWrapper and F.f in FRAME_FUNCTIONS:
+      stack, frames, dictionary = FRAME_FUNCTIONS[F.f](
+        stack, frames, dictionary)
+
+    else:
+      if frames:
+        segment, frames = frames
+      else:
+        segment = ()
+      stack, segment, dictionary = F(stack, segment, dictionary)
+      if segment:
+        frames = segment, frames
+
+  if viewer: viewer(stack, ())
+  return stack, (), dictionary
+
+
+#
+# § Frame versions of the combinators.
+#
+# These take and return (stack, frames, dictionary) and must never push
+# an empty segment.
+#
+
+
+def _i(stack, frames, dictionary):
+  quote, stack = stack
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _x(stack, frames, dictionary):
+  quote, _ = stack
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _b(stack, frames, dictionary):
+  q, (p, stack) = stack
+  if q:
+    frames = q, frames
+  if p:
+    frames = p, frames
+  return stack, frames, dictionary
+
+
+def _dupdip(stack, frames, dictionary):
+  quote, stack = stack
+  frames = (stack[0], ()), frames
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _infra(stack, frames, dictionary):
+  quote, (aggregate, stack) = stack
+  frames = (stack, (S_swaack, ())), frames
+  if quote:
+    frames = quote, frames
+  return aggregate, frames, dictionary
+
+
+def _branch(stack, frames, dictionary):
+  then, (else_, (flag, stack)) = stack
+  quote = then if flag else else_
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _dip(stack, frames, dictionary):
+  quote, (x, stack) = stack
+  frames = (x, ()), frames
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _dipd(stack, frames, dictionary):
+  quote, (x, (y, stack)) = stack
+  frames = (y, (x, ())), frames
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _dipdd(stack, frames, dictionary):
+  quote, (x, (y, (z, stack))) = stack
+  frames = (z, (y, (x, ()))), frames
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _times(stack, frames, dictionary):
+  quote, (n, stack) = stack
+  if n <= 0:
+    return stack, frames, dictionary
+  n -= 1
+  if n:
+    frames = (n, (quote, (S_times, ()))), frames
+  if quote:
+    frames = quote, frames
+  return stack, frames, dictionary
+
+
+def _loop(stack, frames, dictionary):
+  quote, (flag, stack) = stack
+  if flag:
+    frames = (quote, (S_loop, ())), frames
+    if quote:
+      frames = quote, frames
+  return stack, frames, dictionary
+
+
+FRAME_FUNCTIONS = {
+  b: _b,
+  branch: _branch,
+  dip: _dip,
+  dipd: _dipd,
+  dipdd: _dipdd,
+  dupdip: _dupdip,
+  i: _i,
+  infra: _infra,
+  loop: _loop,
+  times: _times,
+  x: _x,
+  }
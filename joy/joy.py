@@ -47,7 +47,7 @@ Exports:
 
   run(text, stack, dictionary, viewer=None)
 
-  repl(stack=(), dictionary=())
+  repl(stack=(), dictionary=None, trace_printer=TracePrinter)
 
 '''
 from __future__ import print_function
@@ -56,7 +56,7 @@ try:
 except NameError:
   pass
 from traceback import print_exc, format_exc
-from .parser import text_to_expression, ParseError, Symbol
+from .parser import ParseError, Symbol, parse_cache
 from .utils.stack import stack_to_string
 from .utils.pretty_print import TracePrinter
 
@@ -85,18 +85,20 @@ def run(text, stack, dictionary, viewer=None):
   Return the stack resulting from running the Joy code text on the stack.
   '''
   try:
-    expression = text_to_expression(text)
+    expression = parse_cache.parse(text)
   except ParseError as err:
     print('Err:', err.message)
     return stack, (), dictionary
   return joy(stack, expression, dictionary, viewer)
 
 
-def repl(stack=(), dictionary=None):
+def repl(stack=(), dictionary=None, trace_printer=TracePrinter):
   '''
   Read-Evaluate-Print Loop
 
-  Accept input and run it on the stack, loop.
+  Accept input and run it on the stack, loop.  A new trace_printer is
+  made for each line (see pretty_print.py for ones that don't keep the
+  whole trace.)
   '''
   if dictionary is None:
     dictionary = {}
@@ -109,7 +111,7 @@ def repl(stack=(), dictionary=None):
         text = input('joy? ')
       except (EOFError, KeyboardInterrupt):
         break
-      viewer = TracePrinter()
+      viewer = trace_printer()
       try:
         stack, _, dictionary = run(text, stack, dictionary, viewer.viewer)
       except:
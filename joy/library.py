@@ -20,8 +20,16 @@
 from inspect import getdoc
 import operator, math
 
-from .parser import text_to_expression, Symbol
-from .utils.stack import list_to_stack, iter_stack, pick, pushback
+from .linker import Dictionary
+from .parser import text_to_expression, Symbol, parse_cache
+from .utils.stack import (
+  expression_to_string,
+  iter_stack,
+  list_to_stack,
+  pick,
+  pushback,
+  )
+from .utils.vector import Vector, pack
 
 
 ALIASES = (
@@ -86,7 +94,6 @@ ternary == [stack [popop pop] dip] dinfrirst
 pam == [i] map
 run == [] swap infra
 sqr == dup mul
-size == 0 swap [pop ++] step
 cleave == [i] app2 [popd] dip
 average == [sum 1.0 *] [size] cleave /
 gcd == 1 [tuck modulus dup 0 >] loop pop
@@ -190,9 +197,12 @@ class DefinitionWrapper(FunctionWrapper):
   Provide implementation of defined functions, and some helper methods.
   '''
 
-  def __init__(self, name, body_text, doc=None):
+  def __init__(self, name, body_text, doc=None, body=None):
+    '''
+    If body is given it's used as the already-parsed body_text.
+    '''
     self.name = self.__name__ = name
-    self.body = text_to_expression(body_text)
+    self.body = text_to_expression(body_text) if body is None else body
     self._body = tuple(iter_stack(self.body))
     self.__doc__ = doc or body_text
 
@@ -212,20 +222,254 @@ class DefinitionWrapper(FunctionWrapper):
     return class_(name, body_text)
 
   @classmethod
-  def add_definitions(class_, defs, dictionary):
-    for definition in _text_to_defs(defs):
-      class_.add_def(definition, dictionary)
+  def add_definitions(class_, defs, dictionary, optimize=False):
+    '''
+    Add the definitions, one per line, to the dictionary.  If optimize
+    is true the bodies are rewritten by the peephole optimizer first
+    (see optimizer.py) and the total number of steps saved is returned.
+    '''
+    try:
+      return sum(
+        class_._add_def(definition, dictionary, optimize)
+        for definition in _text_to_defs(defs)
+        )
+    finally:
+      _invalidate_compiled(dictionary)  # Once, not for each definition.
+
+  @classmethod
+  def add_def(class_, definition, dictionary, optimize=False):
+    saved = class_._add_def(definition, dictionary, optimize)
+    _invalidate_compiled(dictionary)
+    return saved
 
   @classmethod
-  def add_def(class_, definition, dictionary):
+  def _add_def(class_, definition, dictionary, optimize):
     F = class_.parse_definition(definition)
+    saved = 0
+    if optimize:
+      from .optimizer import optimize as rewrite
+      body, saved = rewrite(F.body, dictionary)
+      if saved:
+        F = class_(F.name, expression_to_string(body), F.__doc__, body)
     dictionary[F.name] = F
+    return saved
 
 
 def _text_to_defs(text):
   return filter(None, (line.strip() for line in text.splitlines()))
 
 
+class CompiledDefinitionWrapper(DefinitionWrapper):
+  '''
+  A DefinitionWrapper that turns its body into a chain of pre-resolved
+  Python closures the first time it's called and runs that directly
+  instead of pushing the whole body back onto the expression.
+
+  The leading run of literals, simple functions, builtins and other
+  straight-line definitions is applied straight to the stack.  The first
+  term that needs the expression (a combinator, usually) is called
+  directly with only the remainder of the body pushed back, so in the
+  common case of a definition ending with a combinator nothing is
+  pushed back at all.  A definition made entirely of straight-line terms
+  becomes a plain stack function and is inlined into its callers.
+
+  The intermediate states aren't seen by a viewer, which is the price
+  of skipping the interpreter.  A chain is kept for one dictionary at
+  one version (see Dictionary in linker.py) so any change to the words,
+  e.g. by use_native() or specialize(), has it re-resolved against the
+  new ones.  (A plain dict has no version; there add_def() discards the
+  compiled chains.)
+  '''
+
+  def __init__(self, name, body_text, doc=None, body=None):
+    DefinitionWrapper.__init__(self, name, body_text, doc, body)
+    self.invalidate()
+
+  def invalidate(self):
+    self._compiled_for = self._compiled_version = None
+    self._chain = self._stack_function = None
+
+  def __call__(self, stack, expression, dictionary):
+    if (self._compiled_for is not dictionary
+        or self._compiled_version is not getattr(dictionary, 'version', None)):
+      self.compile(dictionary)
+    return self._chain(stack, expression, dictionary)
+
+  def compile(self, dictionary):
+    '''
+    Resolve the body against the dictionary and build the chain.
+    '''
+    self._compiled_for = dictionary
+    self._compiled_version = getattr(dictionary, 'version', None)
+    self._chain = _interpret_body(self._body)  # In case of recursion.
+    functions = []
+    for index, term in enumerate(self._body):
+      if not isinstance(term, Symbol):
+        functions.append(_push_literal(term))
+        continue
+      F = dictionary.get(term)
+      f = _stack_function_of(F, dictionary)
+      if f is None:
+        self._chain = _call_then_push(
+          _compose(functions), term, F, self._body[index + 1:])
+        return
+      functions.append(f)
+    f = self._stack_function = _compose(functions)
+    self._chain = lambda stack, expression, dictionary: (
+      f(stack), expression, dictionary)
+
+  def stack_function(self, dictionary):
+    '''
+    Return a stack -> stack function equivalent to this definition, or
+    None if the definition needs the expression.
+    '''
+    if (self._compiled_for is not dictionary
+        or self._compiled_version is not getattr(dictionary, 'version', None)):
+      self.compile(dictionary)
+    return self._stack_function
+
+
+class _Materialize(object):
+  '''
+  Stands in for the body and _body of a LazyDefinitionWrapper until one
+  of them is first looked up, then parses the body text into instance
+  attributes of the same names, which hide it from then on.
+  '''
+
+  def __init__(self, attribute):
+    self.attribute = attribute
+
+  def __get__(self, F, class_):
+    if F is None:
+      return self
+    F.materialize()
+    return F.__dict__[self.attribute]
+
+
+class LazyDefinitionWrapper(DefinitionWrapper):
+  '''
+  A DefinitionWrapper that keeps the text of its body and only parses it
+  the first time the body is needed, which is usually the first time the
+  word is run.  Until then it's a name and a string, and help works
+  from the string.  (So a body that doesn't parse raises its ParseError
+  when the word is first run rather than when it's defined.)
+
+  Anything that looks at every definition's body in a dictionary
+  (specialize(), optimize_definitions(), the Sampler) materializes them
+  all.
+  '''
+
+  body = _Materialize('body')
+  _body = _Materialize('_body')
+
+  def __init__(self, name, body_text, doc=None, body=None):
+    self.name = self.__name__ = name
+    self.body_text = body_text
+    self.__doc__ = doc or body_text
+    if body is not None:
+      self.materialize(body)
+
+  @property
+  def materialized(self):
+    return 'body' in self.__dict__
+
+  def materialize(self, body=None):
+    '''Parse the body text, or use the already parsed body.'''
+    if body is None:
+      body = text_to_expression(self.body_text)
+    self.body = body
+    self._body = tuple(iter_stack(body))
+
+
+class LazyCompiledDefinitionWrapper(
+  LazyDefinitionWrapper,
+  CompiledDefinitionWrapper,
+  ):
+  '''
+  A CompiledDefinitionWrapper that parses its body lazily.
+  '''
+
+  def __init__(self, name, body_text, doc=None, body=None):
+    LazyDefinitionWrapper.__init__(self, name, body_text, doc, body)
+    self.invalidate()
+
+
+def materialized_words(dictionary):
+  '''
+  Return two sorted lists of the names of the lazy definitions in the
+  dictionary: the ones that have been materialized and the ones that
+  haven't.
+  '''
+  lazy = [
+    (name, F.materialized)
+    for name, F in dictionary.iteritems()
+    if isinstance(F, LazyDefinitionWrapper)
+    ]
+  return (
+    sorted(name for name, materialized in lazy if materialized),
+    sorted(name for name, materialized in lazy if not materialized),
+    )
+
+
+def _invalidate_compiled(dictionary):
+  for F in dictionary.itervalues():
+    if isinstance(F, CompiledDefinitionWrapper):
+      F.invalidate()
+
+
+def _stack_function_of(F, dictionary):
+  if isinstance(F, SimpleFunctionWrapper):
+    return F.f
+  if isinstance(F, BinaryBuiltinWrapper):
+    return _binary(F.f)
+  if isinstance(F, UnaryBuiltinWrapper):
+    return _unary(F.f)
+  if isinstance(F, CompiledDefinitionWrapper):
+    return F.stack_function(dictionary)
+  return None
+
+
+def _push_literal(term):
+  return lambda stack: (term, stack)
+
+
+def _binary(f):
+  def binary((a, (b, stack))):
+    return f(b, a), stack
+  return binary
+
+
+def _unary(f):
+  def unary((a, stack)):
+    return f(a), stack
+  return unary
+
+
+def _compose(functions):
+  functions = tuple(functions)
+  if len(functions) == 1:
+    return functions[0]
+  def composed(stack):
+    for f in functions:
+      stack = f(stack)
+    return stack
+  return composed
+
+
+def _call_then_push(prefix, term, F, rest):
+  def chain(stack, expression, dictionary):
+    stack = prefix(stack)
+    if rest:
+      expression = list_to_stack(rest, expression)
+    return (F or dictionary[term])(stack, expression, dictionary)
+  return chain
+
+
+def _interpret_body(body):
+  return lambda stack, expression, dictionary: (
+    stack, list_to_stack(body, expression), dictionary)
+
+
 #
 # Functions
 #
@@ -233,7 +477,7 @@ def _text_to_defs(text):
 
 def parse((text, stack)):
   '''Parse the string on the stack to a Joy expression.'''
-  expression = text_to_expression(text)
+  expression = parse_cache.parse(text)
   return expression, stack
 
 
@@ -359,13 +603,13 @@ def select(stack):
 def max_(S):
   '''Given a list find the maximum.'''
   tos, stack = S
-  return max(iter_stack(tos)), stack
+  return max(_items(tos)), stack
 
 
 def min_(S):
   '''Given a list find the minimum.'''
   tos, stack = S
-  return min(iter_stack(tos)), stack
+  return min(_items(tos)), stack
 
 
 def sum_(S):
@@ -374,7 +618,52 @@ def sum_(S):
   sum == 0 swap [+] step
   '''
   tos, stack = S
-  return sum(iter_stack(tos)), stack
+  return sum(_items(tos)), stack
+
+
+def size(S):
+  '''Given a list return the number of items in it.
+
+  size == 0 swap [pop ++] step
+  '''
+  tos, stack = S
+  n = 0
+  while tos:
+    if isinstance(tos, Vector):
+      n += tos.size()
+      break
+    n += 1
+    tos = tos[1]
+  return n, stack
+
+
+def vector(S):
+  '''
+  Pack the list of numbers on the stack into a Vector, which is the same
+  list but some words (and arithmetic) work on it much faster.  (See
+  utils/vector.py.)  A list that won't pack is left as it is.
+  '''
+  tos, stack = S
+  if not isinstance(tos, Vector):
+    packed = pack(list(iter_stack(tos)))
+    if packed is not None:
+      tos = packed
+  return tos, stack
+
+
+def unvector(S):
+  '''Turn a Vector on the stack back into a list of cons cells.'''
+  tos, stack = S
+  if isinstance(tos, Vector):
+    tos = tos.as_stack()
+  return tos, stack
+
+
+def _items(aggregate):
+  '''Iterate the items of a list, straight from the array of a Vector.'''
+  if isinstance(aggregate, Vector):
+    return aggregate.items()
+  return iter_stack(aggregate)
 
 
 def remove(S):
@@ -404,6 +693,8 @@ def unique(S):
 def sort_(S):
   '''Given a list return it sorted.'''
   tos, stack = S
+  if isinstance(tos, Vector):
+    return tos.sorted(), stack
   return list_to_stack(sorted(iter_stack(tos))), stack
 
 
@@ -543,6 +834,9 @@ def reverse(S):
 def concat(S):
   '''Concatinate the two lists on the top of the stack.'''
   (tos, (second, stack)) = S
+  if (isinstance(tos, Vector) and isinstance(second, Vector)
+      and tos.data.typecode == second.data.typecode):
+    return second.concat(tos), stack
   for term in reversed(list(iter_stack(second))):
     tos = term, tos
   return tos, stack
@@ -568,7 +862,7 @@ def zip_(S):
   (tos, (second, stack)) = S
   accumulator = [
     (a, (b, ()))
-    for a, b in zip(iter_stack(tos), iter_stack(second))
+    for a, b in zip(_items(tos), _items(second))
     ]
   return list_to_stack(accumulator), stack
 
@@ -1262,6 +1556,7 @@ primitives = (
   SimpleFunctionWrapper(rolldown),
   SimpleFunctionWrapper(rollup),
   SimpleFunctionWrapper(select),
+  SimpleFunctionWrapper(size),
   SimpleFunctionWrapper(shunt),
   SimpleFunctionWrapper(sort_),
   SimpleFunctionWrapper(stack_),
@@ -1273,9 +1568,11 @@ primitives = (
   SimpleFunctionWrapper(truthy),
   SimpleFunctionWrapper(tuck),
   SimpleFunctionWrapper(uncons),
+  SimpleFunctionWrapper(unvector),
   SimpleFunctionWrapper(unique),
   SimpleFunctionWrapper(unstack),
   SimpleFunctionWrapper(unstack),
+  SimpleFunctionWrapper(vector),
   SimpleFunctionWrapper(void),
   SimpleFunctionWrapper(zip_),
 
@@ -1284,12 +1581,29 @@ primitives = (
   )
 
 
-def initialize(dictionary=None):
+def initialize(dictionary=None, compiled=False, lazy=False):
+  '''
+  Put the library in the dictionary (a new one by default.)  If lazy is
+  true the definitions are only parsed when they're first used, see
+  LazyDefinitionWrapper and materialized_words().
+  '''
   if dictionary is None:
-    dictionary = {}
+    dictionary = Dictionary()
+  _add_functions(dictionary)
+  definition_wrapper(compiled, lazy).add_definitions(definitions, dictionary)
+  return dictionary
+
+
+def definition_wrapper(compiled=False, lazy=False):
+  '''Return the DefinitionWrapper class for the options.'''
+  if lazy:
+    return LazyCompiledDefinitionWrapper if compiled else LazyDefinitionWrapper
+  return CompiledDefinitionWrapper if compiled else DefinitionWrapper
+
+
+def _add_functions(dictionary):
+  '''Put the words written in Python, and their aliases, in the dictionary.'''
   dictionary.update((F.name, F) for F in builtins)
   dictionary.update((F.name, F) for F in combinators)
   dictionary.update((F.name, F) for F in primitives)
   add_aliases(dictionary)
-  DefinitionWrapper.add_definitions(definitions, dictionary)
-  return dictionary
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Versioned Dictionaries
+
+
+Things that are worked out from the words in a dictionary and kept for
+later (compiled definitions, memoized results, vectorized loops, pools
+of workers) have to be thrown away when a word they depend on changes.
+A Dictionary is a dict that carries a version stamp, replaced whenever
+a word is (re)bound or removed, so such things can be kept for one
+dictionary at one version and made again when the version changes.  So
+you can still replace functions in the dictionary at any time (see "4.
+Replacing Functions in the Dictionary") and the change is seen by the
+very next evaluation of the word.
+
+§ Layered Dictionaries
+
+
+A session that defines words changes its dictionary, so sessions that
+mustn't see each other's words each need a dictionary of their own.
+Rather than initialize() one for each, put the library in a
+FrozenDictionary, which can't be changed, and give each session a
+LayeredDictionary on top of it:
+
+  base = FrozenDictionary(initialize())
+  session = LayeredDictionary(base)
+
+A LayeredDictionary holds the words defined (or deleted) in it and
+looks up everything else in its base, so it costs next to nothing to
+make and thousands of them share the one library.  The first time a
+word of the base is looked up it's copied into the layer (just the
+reference, the function isn't copied), so from then on lookups are
+plain dict lookups.  Words defined in a session are seen by the
+definitions of the base when they run in that session, as usual, and
+by no other session.  Changes to a layer are made under a lock, and the
+base never changes, so sessions can be used from any number of threads.
+
+CompiledDefinitionWrappers compile themselves against the dictionary
+they're run with, so they can't be shared by sessions and a
+FrozenDictionary won't take them.
+
+Exports:
+
+  Dictionary
+
+  FrozenDictionary
+
+  LayeredDictionary
+
+'''
+from threading import RLock
+
+
+class Dictionary(dict):
+  '''
+  A dict that gets a fresh version stamp every time it is modified.
+
+  The stamps are unique objects rather than counters so that something
+  kept for one dictionary can never be mistaken as valid for another.
+  '''
+
+  def __init__(self, *args, **kw):
+    dict.__init__(self, *args, **kw)
+    self.version = object()
+
+  def _changed(self):
+    self.version = object()
+
+  def __setitem__(self, key, value):
+    dict.__setitem__(self, key, value)
+    self._changed()
+
+  def __delitem__(self, key):
+    dict.__delitem__(self, key)
+    self._changed()
+
+  def clear(self):
+    dict.clear(self)
+    self._changed()
+
+  def pop(self, *args):
+    try:
+      return dict.pop(self, *args)
+    finally:
+      self._changed()
+
+  def popitem(self):
+    try:
+      return dict.popitem(self)
+    finally:
+      self._changed()
+
+  def setdefault(self, key, default=None):
+    try:
+      return dict.setdefault(self, key, default)
+    finally:
+      self._changed()
+
+  def update(self, *args, **kw):
+    dict.update(self, *args, **kw)
+    self._changed()
+
+
+class FrozenDictionary(Dictionary):
+  '''
+  A Dictionary that can't be changed after it's made, to be shared as
+  the base of LayeredDictionaries.
+  '''
+
+  def __init__(self, *args, **kw):
+    Dictionary.__init__(self, *args, **kw)
+    from .library import CompiledDefinitionWrapper
+    for F in self.itervalues():
+      if isinstance(F, CompiledDefinitionWrapper):
+        raise TypeError(
+          'A FrozenDictionary cannot hold compiled definitions.')
+
+  def _read_only(self, *args, **kw):
+    raise TypeError('A FrozenDictionary cannot be changed.')
+
+  __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+    update = _read_only
+
+
+class LayeredDictionary(Dictionary):
+  '''
+  A Dictionary of the words defined in this layer that looks up any
+  other word in the FrozenDictionary base.
+  '''
+
+  def __init__(self, base, *args, **kw):
+    if not isinstance(base, FrozenDictionary):
+      raise TypeError('The base must be a FrozenDictionary.')
+    Dictionary.__init__(self, *args, **kw)
+    self.base = base
+    self.hidden = set()  # Words of the base deleted in this layer.
+    self._lock = RLock()
+
+  def __missing__(self, key):
+    F = self.base[key]
+    with self._lock:
+      if key in self.hidden:
+        raise KeyError(key)
+      return dict.setdefault(self, key, F)  # Copy it into the layer.
+
+  def __contains__(self, key):
+    return dict.__contains__(self, key) or (
+      key in self.base and key not in self.hidden)
+
+  has_key = __contains__
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def local_items(self):
+    '''Return a list of the (name, function) pairs defined in this layer.'''
+    base = self.base
+    return [
+      (key, F)
+      for key, F in dict.items(self)
+      if dict.get(base, key) is not F
+      ]
+
+  def _merged(self):
+    merged = dict(self.base)
+    for key in self.hidden:
+      del merged[key]
+    dict.update(merged, dict.items(self))
+    return merged
+
+  def __len__(self):
+    return len(self._merged())
+
+  def __iter__(self):
+    return iter(self._merged())
+
+  iterkeys = __iter__
+
+  def keys(self):
+    return self._merged().keys()
+
+  def values(self):
+    return self._merged().values()
+
+  def items(self):
+    return self._merged().items()
+
+  def itervalues(self):
+    return self._merged().itervalues()
+
+  def iteritems(self):
+    return self._merged().iteritems()
+
+  def copy(self):
+    '''Return a new layer on the same base with the same words.'''
+    with self._lock:
+      layer = LayeredDictionary(self.base, dict.items(self))
+      layer.hidden.update(self.hidden)
+    return layer
+
+  # Changes.
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      dict.__setitem__(self, key, value)
+      self.hidden.discard(key)
+      self._changed()
+
+  def __delitem__(self, key):
+    with self._lock:
+      if key in self.base and key not in self.hidden:
+        self.hidden.add(key)
+        dict.pop(self, key, None)
+      else:
+        dict.__delitem__(self, key)
+      self._changed()
+
+  def clear(self):
+    with self._lock:
+      dict.clear(self)
+      self.hidden.update(self.base)
+      self._changed()
+
+  def pop(self, key, *default):
+    with self._lock:
+      try:
+        value = self[key]
+      except KeyError:
+        if default:
+          return default[0]
+        raise
+      del self[key]
+      return value
+
+  def popitem(self):
+    with self._lock:
+      for key in self:
+        return key, self.pop(key)
+    raise KeyError('popitem(): dictionary is empty')
+
+  def setdefault(self, key, default=None):
+    with self._lock:
+      try:
+        return self[key]
+      except KeyError:
+        self[key] = default
+        return default
+
+  def update(self, *args, **kw):
+    items = dict(*args, **kw)
+    with self._lock:
+      dict.update(self, items)
+      self.hidden.difference_update(items)
+      self._changed()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Memoization
+
+
+A recursive definition like
+
+  fib == [1 <=] [] [-- dup -- [fib] dip fib +] ifte
+
+computes the same things over and over.  Because Joy functions are
+functions of the stack, if a word only looks at the top n items (its
+arity) and leaves the rest of the stack alone, its result can be cached
+keyed on those n items:
+
+  memoize(dictionary, 'fib', 1)
+
+replaces fib in the dictionary with a MemoWrapper, so the recursive
+calls find it too.  The memo combinator does the same for a quote:
+
+     ... a b c 2 [Q] memo
+  --------------------------
+         ... a b c Q
+
+with the result cached on [Q], b and c.  (Put it in a dictionary with
+use_memo(dictionary).)
+
+Only pure code can be memoized: anything that uses (directly, through a
+definition, or in a quote) a word in IMPURE, an async word (see
+coroutine.py) or a word not in the dictionary is rejected with a
+ValueError.  The arity is taken on trust,
+except that if the translator can work out the stack effect of a
+definition (see translator.py) it's checked against that.  After each
+miss the result is checked to see that the items under the top n are
+untouched, and if not it isn't cached.
+
+Keys are the version of the dictionary (see Dictionary in linker.py)
+and the items (and quote) with the types of everything in them, so 1
+and 1.0 and True are kept apart, as are a word and a string, inside
+quotes as well as at the top level.  A version stamp belongs
+to one dictionary and is replaced whenever the dictionary changes, so a
+result is never taken from another dictionary (another session's layer,
+say) or from before a word was redefined.  memoize() only works on
+Dictionaries; in a plain dict, which has no version, memo just runs the
+quote.  Unhashable items just aren't cached.
+
+Caches are LRUCaches (see utils/lru.py) bounded by the number of
+entries, the (estimated) memory they use, or both, and they keep hit
+and miss counts.  Results for old versions aren't used again and are
+pushed out in time, or call clear().
+
+Misses are evaluated by a nested call to nested_joy() (see budget.py),
+so they count against a Budget, and a deep recursion through a memoized
+word is limited by Python's recursion limit.
+
+Exports:
+
+  IMPURE
+
+  LRUCache(max_items=None, max_bytes=None)
+
+  MemoWrapper(F, arity, cache=None)
+
+  is_pure(expression, dictionary)
+
+  memoize(dictionary, name, arity, cache=None)
+
+  unmemoize(dictionary, name)
+
+  memo_cache
+
+  use_memo(dictionary)
+
+'''
+from .coroutine import AsyncWrapper
+from .budget import nested_joy
+from .library import DefinitionWrapper, FunctionWrapper
+from .parser import Symbol
+from .translator import Untranslatable, infer_stack_effect
+from .utils.lru import LRUCache
+from .utils.stack import iter_stack, list_to_stack
+
+
+# Words whose results depend on (or that change) more than the items
+# they take from the stack, or that do I/O.  (AsyncWrappers all do I/O
+# and are impure whatever their names.)
+IMPURE = frozenset('''
+  clear help sharing stack swaack unstack warranty words
+  '''.split())
+
+
+def is_pure(expression, dictionary):
+  '''
+  Return True if the expression (and every definition and quote it
+  uses) only uses words that are in the dictionary and not in IMPURE.
+  '''
+  seen = set()
+  to_do = [expression]
+  while to_do:
+    expression = to_do.pop()
+    while expression:
+      term, expression = expression
+      if isinstance(term, tuple):
+        to_do.append(term)  # It might be run.
+        continue
+      if not isinstance(term, Symbol) or term in seen:
+        continue
+      seen.add(term)
+      if term in IMPURE or term not in dictionary:
+        return False
+      F = dictionary[term]
+      if isinstance(F, MemoWrapper):
+        F = F.F
+      if isinstance(F, AsyncWrapper):
+        return False
+      if isinstance(F, DefinitionWrapper):
+        to_do.append(F.body)
+  return True
+
+
+_MISSING = object()
+
+
+def _strict(thing):
+  '''
+  Return a form of the item that is only equal to another's if == can't
+  tell them apart and neither can their types, all the way down: unlike
+  the items themselves a word and a string, or 1, 1.0 and True (in
+  quotes or not) have different forms.  Quotes become the type of the
+  quote, the forms of their items and None.
+  '''
+  form = []
+  to_do = [iter((thing,))]
+  while to_do:
+    for item in to_do[-1]:
+      if isinstance(item, tuple):
+        form.append(type(item))
+        to_do.append(iter_stack(item))
+        break
+      form.append((type(item), item))
+    else:
+      to_do.pop()
+      form.append(None)
+  return tuple(form)
+
+
+def _call(cache, tag, arity, stack, run, dictionary):
+  '''
+  Return run(stack) taking it from the cache if possible, keyed on the
+  version of the dictionary, tag and the top arity items.
+  '''
+  version = getattr(dictionary, 'version', None)
+  if version is None:
+    return run(stack)
+  items = []
+  rest = stack
+  for _ in range(arity):
+    if not rest:
+      return run(stack)  # Let it fail in the usual way.
+    item, rest = rest
+    items.append(item)
+  key = version, tag, tuple(map(_strict, items))
+  try:
+    outputs = cache.get(key, _MISSING)
+  except TypeError:  # Unhashable.
+    return run(stack)
+  if outputs is not _MISSING:
+    return list_to_stack(outputs, rest)
+  result = run(stack)
+  outputs = _outputs(result, rest)
+  if outputs is not None:
+    cache.put(key, outputs)
+  return result
+
+
+def _outputs(result, rest):
+  '''
+  Return the items on result above rest, or None if rest isn't the
+  bottom of result.
+  '''
+  outputs = []
+  while result is not rest:
+    if not result:
+      return None
+    item, result = result
+    outputs.append(item)
+  return tuple(outputs)
+
+
+class MemoWrapper(object):
+  '''
+  Wrap the word F so that its results are cached keyed on the top arity
+  items of the stack.
+  '''
+
+  def __init__(self, F, arity, cache=None):
+    self.F = F
+    self.arity = arity
+    self.cache = LRUCache(max_items=10000) if cache is None else cache
+    self.name = self.__name__ = F.name
+    self.__doc__ = F.__doc__
+
+  def __call__(self, stack, expression, dictionary):
+    stack = _call(self.cache, self.name, self.arity, stack,
+                  lambda stack: self._run(stack, dictionary), dictionary)
+    return stack, expression, dictionary
+
+  def _run(self, stack, dictionary):
+    return nested_joy(*self.F(stack, (), dictionary))[0]
+
+
+def memoize(dictionary, name, arity, cache=None):
+  '''
+  Replace the word name in the dictionary with a MemoWrapper.  Raise
+  ValueError if it isn't pure or takes more than arity items, and
+  TypeError if the dictionary isn't a Dictionary (see linker.py.)
+  '''
+  if getattr(dictionary, 'version', None) is None:
+    raise TypeError('Only words in a Dictionary can be memoized.')
+  F = dictionary[name]
+  if isinstance(F, MemoWrapper):
+    F = F.F
+  if name in IMPURE or not is_pure((Symbol(name), ()), dictionary):
+    raise ValueError('%s is not pure.' % (name,))
+  if isinstance(F, DefinitionWrapper):
+    try:
+      effect = infer_stack_effect(F, dictionary)
+    except (Untranslatable, TypeError, ValueError, ArithmeticError):
+      effect = None
+    if effect and effect[0] > arity:
+      raise ValueError('%s takes %i items, not %i.' % (
+        name, effect[0], arity))
+  W = dictionary[name] = MemoWrapper(F, arity, cache)
+  return W
+
+
+def unmemoize(dictionary, name):
+  '''Put the word back the way it was before memoize().'''
+  F = dictionary[name]
+  if isinstance(F, MemoWrapper):
+    dictionary[name] = F.F
+
+
+# The cache used by the memo combinator.
+memo_cache = LRUCache(max_items=10000)
+
+
+def memo(stack, expression, dictionary):
+  '''
+  Run a quoted program, caching its result on the quote and the top n
+  items of the stack.
+
+     ... n [Q] memo
+  --------------------
+        ... Q
+
+  '''
+  quote, (arity, stack) = stack
+  form = _strict(quote)
+  if not _quote_is_pure(quote, form, dictionary):
+    raise ValueError('Quote is not pure.')
+  stack = _call(memo_cache, form, arity, stack,
+                lambda stack: nested_joy(stack, quote, dictionary)[0],
+                dictionary)
+  return stack, expression, dictionary
+
+
+_pure_quotes = LRUCache(max_items=1000)
+
+
+def _quote_is_pure(quote, form, dictionary):
+  version = getattr(dictionary, 'version', None)
+  if version is None:
+    return is_pure(quote, dictionary)
+  key = version, form
+  try:
+    pure = _pure_quotes.get(key)
+  except TypeError:  # Unhashable, e.g. it holds a Vector.
+    return is_pure(quote, dictionary)
+  if pure is None:
+    pure = is_pure(quote, dictionary)
+    _pure_quotes.put(key, pure)
+  return pure
+
+
+def use_memo(dictionary):
+  '''Put the memo combinator in the dictionary.'''
+  F = FunctionWrapper(memo)
+  dictionary[F.name] = F
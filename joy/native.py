@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Native Looping Combinators
+
+
+The looping combinators in the library work by rewriting the pending
+expression: every iteration of loop, times or step pushes the quote back
+followed by the combinator itself, while is a definition built from
+nullary, dipd and loop, and genrec goes through ifte, infra, first and
+choice each time around.  That's the reference semantics and it's what
+you want for tracing, but it's slow for long loops.
+
+The versions in this module run the loop in Python and only evaluate the
+bodies (by calling nested_joy() on them, see budget.py.)  The results
+are the same but the intermediate states aren't seen by a viewer.  The
+sub-evaluations still count against a Budget.
+
+genrec is the exception: running the recursion in Python would tie its
+depth to Python's recursion limit, so it evaluates the if-part and rec1
+natively but still leaves "[F] rec2" on the pending expression.  primrec
+(rec2 == i) is a tail call and so becomes a plain loop.
+
+  use_native(dictionary)  # Put the native versions in the dictionary.
+  use_native(dictionary, False)  # Put the reference versions back.
+
+'''
+from .budget import nested_joy
+from .library import (
+  FunctionWrapper,
+  S_genrec,
+  _invalidate_compiled,
+  combinators,
+  definition_wrapper,
+  definitions,
+  )
+from .utils.stack import pushback
+
+
+def loop(stack, expression, dictionary):
+  '''
+  Basic loop combinator.
+
+     ... True [Q] loop
+  -----------------------
+       ... Q [Q] loop
+
+     ... False [Q] loop
+  ------------------------
+            ...
+
+  '''
+  quote, (flag, stack) = stack
+  while flag:
+    stack, _, dictionary = nested_joy(stack, quote, dictionary)
+    flag, stack = stack
+  return stack, expression, dictionary
+
+
+def while_(stack, expression, dictionary):
+  '''
+  [if] [body] while
+
+             [P] [Q] while
+  --------------------------------------
+     [P] nullary [Q [P] nullary] loop
+
+  '''
+  body, (if_, stack) = stack
+  while True:
+    (flag, _), _, dictionary = nested_joy(stack, if_, dictionary)
+    if not flag:
+      break
+    stack, _, dictionary = nested_joy(stack, body, dictionary)
+  return stack, expression, dictionary
+
+
+def times(stack, expression, dictionary):
+  '''
+     ... n [Q] . times
+  ---------------------------------
+           ... . Q Q ... Q  (n times)
+
+  '''
+  quote, (n, stack) = stack
+  while n > 0:
+    stack, _, dictionary = nested_joy(stack, quote, dictionary)
+    n -= 1
+  return stack, expression, dictionary
+
+
+def step(stack, expression, dictionary):
+  '''
+  Run a quoted program on each item in a sequence.
+
+     ... [a b c] [Q] . step
+  ----------------------------------------
+               ... a Q b Q c Q .
+
+  '''
+  quote, (aggregate, stack) = stack
+  while aggregate:
+    item, aggregate = aggregate
+    stack, _, dictionary = nested_joy((item, stack), quote, dictionary)
+  return stack, expression, dictionary
+
+
+_last_bundle = ()
+
+
+def genrec(stack, expression, dictionary):
+  '''
+  General Recursion Combinator.
+
+                          [if] [then] [rec1] [rec2] genrec
+    ---------------------------------------------------------------------
+       [if] [then] [rec1 [[if] [then] [rec1] [rec2] genrec] rec2] ifte
+
+  The if-part and rec1 are run natively, then and rec2 are left on the
+  pending expression.
+  '''
+  global _last_bundle
+  rec2, (rec1, (then, (if_, stack))) = stack
+  (flag, _), _, dictionary = nested_joy(stack, if_, dictionary)
+  if flag:
+    return stack, pushback(then, expression), dictionary
+  stack, _, dictionary = nested_joy(stack, rec1, dictionary)
+  F = _last_bundle
+  # A recursion through [F] i calls us again with the very same quotes,
+  # so reuse the bundle rather than building it again.
+  if not (F
+          and F[0] is if_
+          and F[1][0] is then
+          and F[1][1][0] is rec1
+          and F[1][1][1][0] is rec2):
+    F = _last_bundle = (if_, (then, (rec1, (rec2, (S_genrec, ())))))
+  return (F, stack), pushback(rec2, expression), dictionary
+
+
+def primrec(stack, expression, dictionary):
+  '''
+  [if] [then] [rec] primrec == [if] [then] [rec] [i] genrec
+
+  Because rec2 is i the recursion is a tail call, so:
+
+      while not if: rec
+      then
+
+  '''
+  rec, (then, (if_, stack)) = stack
+  while True:
+    (flag, _), _, dictionary = nested_joy(stack, if_, dictionary)
+    if flag:
+      break
+    stack, _, dictionary = nested_joy(stack, rec, dictionary)
+  return stack, pushback(then, expression), dictionary
+
+
+native_combinators = (
+  FunctionWrapper(genrec),
+  FunctionWrapper(loop),
+  FunctionWrapper(primrec),
+  FunctionWrapper(step),
+  FunctionWrapper(times),
+  FunctionWrapper(while_),
+  )
+
+
+def use_native(dictionary, native=True):
+  '''
+  Install the native combinators in the dictionary, or if native is
+  false restore the reference ones from the library.
+  '''
+  if native:
+    dictionary.update((F.name, F) for F in native_combinators)
+  else:
+    wrapper = _definition_class(dictionary)
+    dictionary.update(
+      (F.name, _reference(F.name, wrapper)) for F in native_combinators)
+  _invalidate_compiled(dictionary)  # For plain dicts, which have no version.
+
+
+def _reference(name, wrapper):
+  for F in combinators:
+    if F.name == name:
+      return F
+  prefix = name + ' =='
+  for line in definitions.splitlines():
+    if line.startswith(prefix):
+      return wrapper.parse_definition(line)
+  raise KeyError(name)
+
+
+def _definition_class(dictionary):
+  '''
+  Return the class initialize() made the library's definitions with in
+  the dictionary (compiled, lazy...)
+  '''
+  classes = set(
+    definition_wrapper(compiled, lazy)
+    for compiled in (False, True)
+    for lazy in (False, True)
+    )
+  for F in dictionary.itervalues():
+    if type(F) in classes:
+      return type(F)
+  return definition_wrapper()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Peephole Optimizer
+
+
+Joy code written interactively tends to pick up sequences that do
+nothing, or do something the long way round: "swap swap", "dup pop",
+"[...] i", "a [...] dip" and so on.  The optimizer rewrites them using a
+table of Rules, each of which is a pair of Joy expressions:
+
+  Rule('swap swap', '')
+  Rule('$A [$Q] dip', '$Q $A')
+
+Words starting with "$" are pattern variables.  In a pattern a bare
+variable matches any single literal (a number, string or quote, but not
+a word), and a variable alone in a quote matches any quote and stands
+for its contents.  In the replacement a bare variable is spliced in (the
+literal, or the contents of the quote) and a quoted one is a quote.
+
+A rule is only ever applied if it has been proved against the words in
+the dictionary.  Both sides are run symbolically (see translator.py) on
+the same unknown stack, with the quote variables run as unknown
+functions of the whole stack, and the results must be the same.  So if
+you redefine swap, "swap swap" stops being rewritten.  The proof also
+counts the steps each side takes, and a rule has to save at least one.
+(A rewritten expression can succeed on a stack the original would have
+failed on, e.g. "swap swap" on an empty stack, but on any stack where
+the original works the results are the same.)
+
+By default only the top level of an expression is rewritten because a
+quote might be data rather than code.  Quotes that get spliced in by a
+rule are rewritten along with everything else.
+
+  expression, saved = optimize(expression, dictionary)
+
+Add your own rules to RULES (or pass a list of them in.)  Rule() checks
+the syntax; an unprovable rule is simply never applied.
+
+Exports:
+
+  Rule(pattern, replacement)
+
+  RULES
+
+  optimize(expression, dictionary, rules=None, quotes=False)
+
+  optimize_definitions(dictionary, names=None, rules=None)
+
+'''
+from .library import DefinitionWrapper, SimpleFunctionWrapper
+from .parser import Symbol, text_to_expression
+from .translator import (
+  PRIMITIVES,
+  Translation,
+  Translator,
+  Untranslatable,
+  Value,
+  )
+from .utils.stack import expression_to_string, iter_stack, list_to_stack
+
+
+# How many rewrites one call to optimize() may do.
+MAX_REWRITES = 10000
+
+
+def _variable(term):
+  '''Return the name of the pattern variable term, or None.'''
+  if isinstance(term, Symbol) and term.startswith('$') and len(term) > 1:
+    return str(term)
+  return None
+
+
+def _quote_variable(term):
+  '''Return the name of the variable in a quote like [$Q], or None.'''
+  if isinstance(term, tuple) and term and not term[1]:
+    return _variable(term[0])
+  return None
+
+
+class Rule(object):
+  '''
+  A rewrite rule.  See the module docstring for the pattern language.
+  '''
+
+  def __init__(self, pattern, replacement):
+    self.pattern = tuple(iter_stack(text_to_expression(pattern)))
+    self.replacement = tuple(iter_stack(text_to_expression(replacement)))
+    self.text = '%s  ->  %s' % (pattern, replacement)
+    if not self.pattern:
+      raise ValueError('Empty pattern in rule %r' % (self.text,))
+    self.literals, self.quotes = set(), set()
+    for term in self.pattern:
+      if _variable(term):
+        self.literals.add(_variable(term))
+      elif _quote_variable(term):
+        self.quotes.add(_quote_variable(term))
+    if self.literals & self.quotes:
+      raise ValueError('Variable used two ways in rule %r' % (self.text,))
+    for term in self.replacement:
+      name = _variable(term) or _quote_variable(term)
+      if name and name not in self.literals | self.quotes:
+        raise ValueError('Unbound %s in rule %r' % (name, self.text))
+    self.words = frozenset(
+      term
+      for term in _all_terms(self.pattern + self.replacement)
+      if isinstance(term, Symbol) and not _variable(term)
+      )
+    self._proved = {}
+
+  def __repr__(self):
+    return 'Rule(%r)' % (self.text,)
+
+  def match(self, terms, index):
+    '''
+    Return the bindings if the pattern matches terms at index, else
+    None.  Bindings map variable names to lists of terms.
+    '''
+    if len(terms) - index < len(self.pattern):
+      return None
+    bindings = {}
+    for pattern, term in zip(self.pattern, terms[index:]):
+      name = _variable(pattern)
+      if name:
+        if isinstance(term, Symbol):
+          return None
+        bound = [term]
+      else:
+        name = _quote_variable(pattern)
+        if name:
+          if not isinstance(term, tuple):
+            return None
+          bound = list(iter_stack(term))
+        elif _same(pattern, term):
+          continue
+        else:
+          return None
+      if name in bindings and not _same(bindings[name], bound):
+        return None
+      bindings[name] = bound
+    return bindings
+
+  def substitute(self, bindings):
+    '''Return the list of terms replacing a match with the bindings.'''
+    terms = []
+    for term in self.replacement:
+      name = _variable(term)
+      if name:
+        terms.extend(bindings[name])
+        continue
+      name = _quote_variable(term)
+      if name:
+        terms.append(list_to_stack(bindings[name]))
+      else:
+        terms.append(term)
+    return terms
+
+  def saves(self, dictionary):
+    '''
+    Return the number of steps the rule saves if it's been proved for
+    the words in the dictionary, else 0.
+    '''
+    key = tuple(sorted(
+      (word, id(dictionary.get(word))) for word in self.words))
+    try:
+      return self._proved[key]
+    except KeyError:
+      pass
+    saved = self._proved[key] = _prove(self, dictionary)
+    return saved
+
+
+def _all_terms(terms):
+  to_do = list(terms)
+  while to_do:
+    term = to_do.pop()
+    if isinstance(term, tuple):
+      to_do.extend(iter_stack(term))
+    else:
+      yield term
+
+
+def _same(a, b):
+  '''Like == but a word is never the same as a string, nor 1 as True.'''
+  if isinstance(a, list) and isinstance(b, list):
+    return len(a) == len(b) and all(map(_same, a, b))
+  if type(a) is not type(b):
+    return False
+  if isinstance(a, tuple):
+    return (not a and not b) or (
+      bool(a) and bool(b) and _same(a[0], b[0]) and _same(a[1], b[1]))
+  return a == b
+
+
+#
+# § Proofs
+#
+
+
+def _prove(rule, dictionary):
+  '''
+  Run both sides of the rule symbolically and return the steps saved
+  if they give the same result, else 0.
+  '''
+  try:
+    before, steps_before = _run(rule, rule.pattern, dictionary)
+    after, steps_after = _run(rule, rule.replacement, dictionary)
+  except (Untranslatable, TypeError, ValueError, KeyError, ArithmeticError):
+    return 0
+  if before != after:
+    return 0
+  return max(0, steps_before - steps_after)
+
+
+def _run(rule, terms, dictionary):
+  translation = Translation()
+  bindings = {}
+  for name in rule.literals:
+    bindings[name] = [Value(translation, name)]
+  dictionary = dict(dictionary.items())  # Not just the top layer.
+  primitives = set(PRIMITIVES)
+  for name in rule.quotes:
+    symbol = Symbol(name)
+    bindings[name] = [symbol]
+    F = dictionary[symbol] = _unknown_function(translation, name)
+    primitives.add(F.f)
+  expression = []
+  for term in terms:
+    name = _variable(term)
+    if name:
+      expression.extend(bindings[name])
+      continue
+    name = _quote_variable(term)
+    if name:
+      expression.append(list_to_stack(bindings[name]))
+    else:
+      expression.append(term)
+  translator = Translator(dictionary, translation, set(), primitives)
+  result = translator.run(
+    Value(translation, 'stack'), list_to_stack(expression))
+  return _canonical(result), translator.steps
+
+
+def _unknown_function(translation, name):
+  def f(stack):
+    return translation.new(name + '(%s)', stack)
+  F = SimpleFunctionWrapper(f)
+  F.name = name
+  return F
+
+
+def _canonical(thing):
+  '''
+  Return a form of the symbolic thing that's the same for things that
+  are equal however they were computed, so far as (head, tail) goes.
+  '''
+  if isinstance(thing, Value):
+    if thing.origin:
+      value, index = thing.origin
+      return 'part', index, _canonical(value)
+    if thing.definition:
+      template, args = thing.definition
+      return 'computed', template, tuple(map(_canonical, args))
+    return 'unknown', thing.name
+  if isinstance(thing, tuple):
+    if not thing:
+      return 'nil',
+    head, tail = map(_canonical, thing)
+    if (head[0] == 'part' and head[1] == 0
+        and tail[0] == 'part' and tail[1] == 1
+        and head[2] == tail[2]):
+      return head[2]  # Put back together again.
+    return 'cons', head, tail
+  return 'literal', type(thing).__name__, thing
+
+
+#
+# § Rewriting
+#
+
+
+RULES = [
+  Rule('swap swap', ''),
+  Rule('dup pop', ''),
+  Rule('dup swap', 'dup'),
+  Rule('rollup rolldown', ''),
+  Rule('rolldown rollup', ''),
+  Rule('cons uncons', ''),
+  Rule('uncons cons', ''),
+  Rule('$A pop', ''),
+  Rule('$A $B swap', '$B $A'),
+  Rule('$A $B popd', '$B'),
+  Rule('[] swap concat', ''),
+  Rule('[$P] [] concat', '[$P]'),
+  Rule('[] [$P] concat', '[$P]'),
+  Rule('[$Q] i', '$Q'),
+  Rule('[$Q] x', '[$Q] $Q'),
+  Rule('[$P] [$Q] b', '$P $Q'),
+  Rule('$A [$Q] dip', '$Q $A'),
+  Rule('$A $B [$Q] dipd', '$Q $A $B'),
+  Rule('$A $B $C [$Q] dipdd', '$Q $A $B $C'),
+  Rule('$A [$Q] dupdip', '$A $Q $A'),
+  ]
+
+
+def optimize(expression, dictionary, rules=None, quotes=False):
+  '''
+  Return (expression, saved) where expression has been rewritten by the
+  rules (default RULES) that hold in the dictionary and saved is the
+  number of evaluation steps that saves.  If quotes is true the insides
+  of quotes are optimized too, which is only safe if none of them are
+  used as data.
+  '''
+  if rules is None:
+    rules = RULES
+  rules = [(rule, rule.saves(dictionary)) for rule in rules]
+  rules = [(rule, saved) for rule, saved in rules if saved]
+  terms, saved = _rewrite(list(iter_stack(expression)), rules)
+  if quotes:
+    for index, term in enumerate(terms):
+      if isinstance(term, tuple) and term:
+        term, n = optimize(term, dictionary, [r for r, _ in rules], True)
+        terms[index] = term
+        saved += n
+  return list_to_stack(terms), saved
+
+
+def _rewrite(terms, rules):
+  if not rules:
+    return terms, 0
+  longest = max(len(rule.pattern) for rule, _ in rules)
+  saved = rewrites = index = 0
+  while index < len(terms) and rewrites < MAX_REWRITES:
+    for rule, steps in rules:
+      bindings = rule.match(terms, index)
+      if bindings is not None:
+        terms[index:index + len(rule.pattern)] = rule.substitute(bindings)
+        saved += steps
+        rewrites += 1
+        index = max(0, index - longest + 1)  # It may complete a match.
+        break
+    else:
+      index += 1
+  return terms, saved
+
+
+def optimize_definitions(dictionary, names=None, rules=None):
+  '''
+  Replace definitions in the dictionary with optimized versions, where
+  that changes anything, and return a dict mapping the names of the
+  ones replaced to the number of steps saved by each.
+  '''
+  if names is None:
+    names = sorted(dictionary)
+  changed = {}
+  for name in names:
+    F = dictionary[name]
+    if not isinstance(F, DefinitionWrapper):
+      continue
+    body, saved = optimize(F.body, dictionary, rules)
+    if not saved:
+      continue
+    dictionary[name] = F.__class__(
+      name,
+      expression_to_string(body),
+      doc=F.__doc__,
+      body=body,
+      )
+    changed[name] = saved
+  return changed
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Parallel Evaluation
+
+
+map runs its quote on each item in turn, but each run only sees the
+item and the stack under the list, never the other runs, so they can
+just as well be done at the same time.  The pmap combinator does them
+in a pool of worker processes (from the multiprocessing module), a chunk
+of items per job:
+
+     ... [a b c ...] [Q] pmap
+  ------------------------------
+      ... [a Q  b Q  c Q ...]
+
+The results are in the same order as the items and are the same as
+map's.  Lists of fewer than MIN_ITEMS items aren't worth the trip and
+are mapped here by the library's map instead, as are all lists inside a
+worker or any other daemonic process, like the workers of server.py
+(they can't have workers of their own.)
+
+The workers are started the first time they're needed, with a copy of
+the dictionary pmap was run with, so they don't initialize one per job.
+Each dictionary (and each version of a Dictionary, see linker.py) has a
+pool of its own, so sessions with dictionaries of their own don't make
+each other's workers start again.  The pools are kept for the next pmap
+with the same dictionary; once a pool isn't in use it's stopped if its
+Dictionary has changed since, or if there are more than MAX_POOLS and
+it's the least recently used.  Call shutdown() to stop the workers (it's
+called at exit anyway.)
+
+The quote, the stack and the items go to the workers and the results
+come back in the binary format of utils/serialize.py, which is fast and
+has no limit on the nesting.  Anything it can't write, like a
+FunctionWrapper left on the stack, is pickled instead.  Symbols pickle,
+and so do the wrappers of functions defined at the top level of a
+module.  An error in a worker is raised again by pmap.
+
+The runs in the workers aren't seen by a viewer and can't change the
+dictionary pmap was run with.  They couldn't be counted against a
+Budget either, so inside budgeted_joy() (see budget.py) everything is
+run here, by the library's map and by nested_joy().
+
+papp2, papp3 and pcleave are app2, app3 and cleave with each of their
+two or three runs done by a worker:
+
+     ... x [P] [Q] pcleave
+  ---------------------------
+         ... P(x) Q(x)
+
+They wait for all the runs and then check them in order, so the results
+are the same however the runs were scheduled, and the error raised is
+always the one from the first run (as written) that failed, wrapped in a
+BranchError that says which run that was and carries the worker's
+traceback.
+
+Sending a run to a worker costs about a millisecond, so it only pays for
+heavy quotes.  use_parallel(dictionary, automatic=True) also replaces
+app2, app3 and cleave with versions that estimate the cost of their
+quotes (see cost()) and only use the workers if it's at least
+COST_THRESHOLD, doing what the library's versions do otherwise.
+
+  use_parallel(dictionary)  # Put pmap, papp2, papp3 and pcleave in it.
+
+Exports:
+
+  BranchError(branch, error, traceback='')
+
+  COST_THRESHOLD
+
+  LOOP_COST
+
+  LOOPS
+
+  MAX_POOLS
+
+  MIN_ITEMS
+
+  PROCESSES
+
+  automatic_combinators
+
+  cost(quote, dictionary, limit=None)
+
+  parallel_combinators
+
+  shutdown()
+
+  use_parallel(dictionary, automatic=False)
+
+'''
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from cPickle import dumps as _pickle, loads as _unpickle
+from multiprocessing import Pool, cpu_count, current_process
+from threading import Lock
+from traceback import format_exc
+from . import library
+from .budget import BudgetExceeded, active_budget, nested_joy
+from .joy import joy
+from .library import DefinitionWrapper, FunctionWrapper
+from .parser import Symbol, text_to_expression
+from .utils import serialize
+from .utils.stack import iter_stack, list_to_stack, pushback
+from .utils.vector import Vector, pack
+
+
+# Lists shorter than this are mapped here.
+MIN_ITEMS = 500
+
+# The number of worker processes, None for one per CPU.
+PROCESSES = None
+
+# How many pools are kept when they're not in use.
+MAX_POOLS = 4
+
+# Jobs per worker for each pmap, so a slow chunk doesn't hold up the rest.
+CHUNKS_PER_PROCESS = 4
+
+# The estimated cost at which the automatic app2, app3 and cleave use
+# the workers.
+COST_THRESHOLD = 1000
+
+# Words whose cost depends on the data, and what each counts for.
+LOOPS = frozenset('''
+  genrec loop map pmap primrec step times while
+  '''.split())
+LOOP_COST = 100
+
+
+class BranchError(Exception):
+  '''
+  Raised by papp2, papp3 and pcleave when one of their runs fails.  The
+  branch is the number of the run (from 0) and error is its exception.
+  '''
+
+  def __init__(self, branch, error, traceback=''):
+    Exception.__init__(self, 'Branch %i raised %s: %s' % (
+      branch, type(error).__name__, error))
+    self.branch = branch
+    self.error = error
+    self.traceback = traceback
+
+
+#
+# § The pool.
+#
+
+
+_lock = Lock()
+_pools = OrderedDict()  # key -> _Pool, least recently used first.
+
+# The dictionary of a worker process (None in the main process.)
+_worker_dictionary = None
+
+
+def _start_worker(dictionary):
+  global _worker_dictionary
+  _worker_dictionary = dictionary
+
+
+class _Pool(object):
+  '''The workers for one version of one dictionary.'''
+
+  def __init__(self, dictionary, version):
+    self.dictionary = dictionary
+    self.version = version
+    self.processes = PROCESSES or cpu_count()
+    # The workers are forked, so they get the dictionary as it is now
+    # without it being pickled.
+    self.pool = Pool(self.processes, _start_worker, (dictionary,))
+    self.users = 0
+
+  def stale(self):
+    return getattr(self.dictionary, 'version', None) is not self.version
+
+
+@contextmanager
+def _pool_for(dictionary):
+  '''
+  Use the pool of workers for the dictionary, starting it if need be:
+
+    with _pool_for(dictionary) as (pool, processes):
+      ...
+
+  '''
+  version = getattr(dictionary, 'version', None)
+  key = id(dictionary), version, PROCESSES
+  with _lock:
+    entry = _pools.pop(key, None)
+    if entry is None or entry.dictionary is not dictionary:
+      if entry is not None:  # The id was reused.
+        entry.pool.terminate()
+      entry = _Pool(dictionary, version)
+    _pools[key] = entry  # The most recently used.
+    entry.users += 1
+  try:
+    yield entry.pool, entry.processes
+  finally:
+    with _lock:
+      entry.users -= 1
+      _retire()
+
+
+def _retire():
+  '''
+  Stop the pools not in use that are stale or, oldest first, more than
+  MAX_POOLS.  Call with the lock held.
+  '''
+  excess = len(_pools) - MAX_POOLS
+  for key, entry in _pools.items():
+    if entry.users or not (excess > 0 or entry.stale()):
+      continue
+    del _pools[key]
+    entry.pool.terminate()
+    excess -= 1
+
+
+def _run_here():
+  '''
+  Return True if the runs have to be done in this process: in a worker
+  (ours or anyone's, as daemonic processes can't have children) or
+  within a Budget.
+  '''
+  return (
+    _worker_dictionary is not None
+    or current_process().daemon
+    or active_budget() is not None
+    )
+
+
+def shutdown():
+  '''Stop the worker processes.'''
+  with _lock:
+    for entry in _pools.itervalues():
+      entry.pool.terminate()
+      entry.pool.join()
+    _pools.clear()
+
+
+atexit.register(shutdown)
+
+
+#
+# § Shipping data.
+#
+
+
+def _pack(thing):
+  try:
+    return 's', serialize.dumps(thing)
+  except TypeError:
+    return 'p', _pickle(thing, 2)
+
+
+def _unpack((kind, data)):
+  return serialize.loads(data) if kind == 's' else _unpickle(data)
+
+
+def _map_chunk((quote_and_stack, items)):
+  '''Run in a worker: map the quote over a chunk of items.'''
+  quote, stack = _unpack(quote_and_stack)
+  dictionary = _worker_dictionary
+  results = [
+    joy((item, stack), quote, dictionary)[0][0]
+    for item in iter_stack(_unpack(items))
+    ]
+  return _pack(list_to_stack(results))
+
+
+def _run_branch(branch):
+  '''
+  Run in a worker: return (True, the packed first item of the result)
+  or (False, (the pickled exception or None, its repr, the traceback.))
+  '''
+  try:
+    quote, stack = _unpack(branch)
+    return True, _pack(joy(stack, quote, _worker_dictionary)[0][0])
+  except Exception as err:
+    try:
+      pickled = _pickle(err, 2)
+      _unpickle(pickled)
+    except Exception:
+      pickled = None
+    return False, (pickled, repr(err), format_exc())
+
+
+def _error(pickled, description):
+  if pickled is not None:
+    try:
+      return _unpickle(pickled)
+    except Exception:
+      pass
+  return Exception(description)
+
+
+def _fork(branches, dictionary):
+  '''
+  Return the first items of the results of running each (quote, stack)
+  in branches, in a worker each if possible.  Raise BranchError for the
+  first that fails.
+  '''
+  if _run_here():
+    results = []
+    for index, (quote, stack) in enumerate(branches):
+      try:
+        results.append(nested_joy(stack, quote, dictionary)[0][0])
+      except BudgetExceeded:
+        raise
+      except Exception as err:
+        raise BranchError(index, err, format_exc())
+    return results
+  with _pool_for(dictionary) as (pool, _):
+    outcomes = pool.map(_run_branch, map(_pack, branches), 1)
+  results = []
+  for index, (ok, outcome) in enumerate(outcomes):
+    if not ok:
+      pickled, description, traceback = outcome
+      raise BranchError(index, _error(pickled, description), traceback)
+    results.append(_unpack(outcome))
+  return results
+
+
+def cost(quote, dictionary, limit=None):
+  '''
+  Estimate the cost of running the quote: the number of terms in it and
+  in the definitions and quotes it uses, with each word in LOOPS (and
+  each recursive use of a definition) counting as LOOP_COST.  Counting
+  stops once it gets to limit (by default COST_THRESHOLD.)
+  '''
+  if limit is None:
+    limit = COST_THRESHOLD
+  total = 0
+  to_do = [(quote, frozenset())]
+  while to_do and total < limit:
+    expression, using = to_do.pop()
+    while expression and total < limit:
+      term, expression = expression
+      total += 1
+      if isinstance(term, tuple):
+        to_do.append((term, using))  # It might be run.
+        continue
+      if not isinstance(term, Symbol):
+        continue
+      if term in LOOPS or term in using:
+        total += LOOP_COST
+        continue
+      F = dictionary.get(term)
+      if isinstance(F, DefinitionWrapper):
+        to_do.append((F.body, using | frozenset((term,))))
+  return total
+
+
+def _heavy(quotes, dictionary):
+  return sum(cost(quote, dictionary) for quote in quotes) >= COST_THRESHOLD
+
+
+def _chunks(items, n):
+  '''Split the list items into about n lists.'''
+  if not items:
+    return []
+  size = -(-len(items) // n)
+  return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+#
+# § Combinators.
+#
+
+
+def pmap(S, expression, dictionary):
+  '''
+  Like map, but the quote is run on the items by a pool of worker
+  processes.
+  '''
+  (quote, (aggregate, stack)) = S
+  items = list(iter_stack(aggregate))
+  if not items or len(items) < MIN_ITEMS or _run_here():
+    return library.map_(S, expression, dictionary)
+  quote_and_stack = _pack((quote, stack))
+  results = []
+  with _pool_for(dictionary) as (pool, processes):
+    jobs = [
+      (quote_and_stack, _pack(list_to_stack(chunk)))
+      for chunk in _chunks(items, processes * CHUNKS_PER_PROCESS)
+      ]
+    for chunk in pool.map(_map_chunk, jobs, 1):
+      results.extend(iter_stack(_unpack(chunk)))
+  vector = isinstance(aggregate, Vector) and pack(results)
+  return (vector or list_to_stack(results), stack), expression, dictionary
+
+
+def papp2(S, expression, dictionary):
+  '''Like app2, with the runs done by worker processes.
+
+            ... y x [Q] . papp2
+     -----------------------------
+              ... Q(y) Q(x)
+
+  '''
+  (quote, (x, (y, stack))) = S
+  ry, rx = _fork([(quote, (y, stack)), (quote, (x, stack))], dictionary)
+  return (rx, (ry, stack)), expression, dictionary
+
+
+def papp3(S, expression, dictionary):
+  '''Like app3, with the runs done by worker processes.
+
+            ... z y x [Q] . papp3
+     ---------------------------------
+              ... Q(z) Q(y) Q(x)
+
+  '''
+  (quote, (x, (y, (z, stack)))) = S
+  rz, ry, rx = _fork([
+    (quote, (z, stack)),
+    (quote, (y, stack)),
+    (quote, (x, stack)),
+    ], dictionary)
+  return (rx, (ry, (rz, stack))), expression, dictionary
+
+
+def pcleave(S, expression, dictionary):
+  '''Like cleave, with the runs done by worker processes.
+
+            ... x [P] [Q] . pcleave
+     ---------------------------------
+                ... P(x) Q(x)
+
+  '''
+  (Q, (P, (x, stack))) = S
+  p, q = _fork([(P, (x, stack)), (Q, (x, stack))], dictionary)
+  return (q, (p, stack)), expression, dictionary
+
+
+def app2(S, expression, dictionary):
+  '''app2, using the workers if the quote is heavy.'''
+  if _heavy([S[0]] * 2, dictionary):
+    return papp2(S, expression, dictionary)
+  return library.app2(S, expression, dictionary)
+
+
+def app3(S, expression, dictionary):
+  '''app3, using the workers if the quote is heavy.'''
+  if _heavy([S[0]] * 3, dictionary):
+    return papp3(S, expression, dictionary)
+  return library.app3(S, expression, dictionary)
+
+
+_CLEAVE = text_to_expression('[i] app2 [popd] dip')
+
+
+def cleave(S, expression, dictionary):
+  '''
+  cleave == [i] app2 [popd] dip
+
+  using the workers if the quotes are heavy.
+  '''
+  (Q, (P, _)) = S
+  if _heavy([P, Q], dictionary):
+    return pcleave(S, expression, dictionary)
+  return S, pushback(_CLEAVE, expression), dictionary
+
+
+parallel_combinators = (
+  FunctionWrapper(pcleave),
+  FunctionWrapper(papp2),
+  FunctionWrapper(papp3),
+  FunctionWrapper(pmap),
+  )
+
+
+automatic_combinators = (
+  FunctionWrapper(app2),
+  FunctionWrapper(app3),
+  FunctionWrapper(cleave),
+  )
+
+
+def use_parallel(dictionary, automatic=False):
+  '''
+  Put the parallel combinators in the dictionary, and if automatic is
+  true the automatic versions of app2, app3 and cleave too.
+  '''
+  dictionary.update((F.name, F) for F in parallel_combinators)
+  if automatic:
+    dictionary.update((F.name, F) for F in automatic_combinators)
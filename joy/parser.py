@@ -33,78 +33,297 @@ As well as a single Symbol class and a single Exception type:
 When supplied with a string this function returns a Python datastructure
 that represents the Joy datastructure described by the text expression.
 Any unbalanced square brackets will raise a ParseError.
+
+There are also two functions for text too big to want in a string:
+
+  read_expression(source, chunk_size=65536)
+
+  iter_expression(source, chunk_size=65536)
+
+The source is a file object or an mmap.  read_expression() returns the
+whole expression, iter_expression() yields its top-level terms one at a
+time so a long data file can be processed without holding all of it.
+
+The tokens are matched by one regular expression (with a group for each
+kind of token) and the expression is built out of cons cells as it
+goes: each open list is kept as a reversed stack of its items and
+reversed when it's closed.  The cyclic garbage collector is paused while
+parsing texts of GC_PAUSE_SIZE characters or more, and files (for
+iter_expression() only while each chunk is): the new cells can't form
+cycles but there are a lot of them, and without the pause the collector
+takes most of the time.  The pause is for the whole process, so it isn't
+done for the small texts where it wouldn't pay, and the collector is
+always turned back on afterwards, even if parsing fails.
+
+A ParseError has the line and column (both counted from 1) of the
+problem.
+
+Programs are often run from the same text over and over, so there's a
+cache for that:
+
+  ParseCache(max_bytes=16777216)
+
+  parse_cache
+
+ParseCache.parse(text) is text_to_expression(text) but keeps the
+expressions it makes (least recently used first out once they use more
+than max_bytes, see utils/lru.py.)  Expressions are never changed once
+made, so the one cached expression can be handed out to every caller.
+run() and the parse word use the parse_cache; its stats() method gives
+the hit rate.  Texts that don't parse are not cached.
 '''
-from re import Scanner
-from .utils.stack import list_to_stack
+import re
+from contextlib import contextmanager
+from gc import disable, enable, isenabled
+from mmap import mmap
+from sys import getsizeof
+from .utils.lru import LRUCache, sizeof
 
 
 class Symbol(str):
   __repr__ = str.__str__
 
 
+class ParseError(ValueError):
+
+  def __init__(self, message, line=None, column=None):
+    if line is not None:
+      message = '%s (line %i, column %i)' % (message, line, column)
+    ValueError.__init__(self, message)
+    self.line = line
+    self.column = column
+
+
 def text_to_expression(text):
   '''
   Convert a text to a Joy expression.
   '''
-  return _parse(_tokenize(text))
+  with _gc_paused(len(text)):
+    return _collect(_parse((text,)))
+
+
+def read_expression(source, chunk_size=65536):
+  '''
+  Convert the text in a file object or an mmap to a Joy expression.
+  '''
+  size = len(source) if isinstance(source, mmap) else None
+  with _gc_paused(size):
+    return _collect(_parse(_chunks(source, chunk_size)))
+
+
+def iter_expression(source, chunk_size=65536):
+  '''
+  Yield the top-level terms of the text in a file object or an mmap.
+  '''
+  batches = _parse(_chunks(source, chunk_size))
+  while True:
+    with _gc_paused():
+      terms = next(batches, None)
+    if terms is None:
+      break
+    for term in _iter(terms):
+      yield term
+
+
+class ParseCache(LRUCache):
+  '''
+  A cache of the expressions made from texts, bounded by the (estimated)
+  bytes they and the texts use.
+  '''
+
+  def __init__(self, max_bytes=16 * 2**20):
+    LRUCache.__init__(self, max_bytes=max_bytes)
+
+  def parse(self, text):
+    '''
+    Return the Joy expression of the text, from the cache if it's there.
+    '''
+    key = type(text), text  # So u'"a"' doesn't give '"a"'s string.
+    expression = self.get(key, _MISSING)
+    if expression is _MISSING:
+      expression = text_to_expression(text)
+      size = getsizeof(text)
+      if size <= self.max_bytes:  # Else it would only evict everything.
+        self.put(key, expression, size + sizeof(expression))
+    return expression
+
+
+_MISSING = object()
+
+
+parse_cache = ParseCache()
+
+
+def _chunks(source, chunk_size):
+  if isinstance(source, mmap):
+    return source,  # The regex can scan it as it is.
+  return iter(lambda: source.read(chunk_size), '')
+
+
+def _collect(batches):
+  batches = list(batches)
+  if not batches:
+    return ()
+  expression = batches.pop()
+  for terms in reversed(batches):
+    expression = _reverse(_reverse(terms), expression)
+  return expression
+
+
+# Texts at least this long are parsed with the garbage collector paused.
+GC_PAUSE_SIZE = 65536
+
+
+@contextmanager
+def _gc_paused(size=None):
+  '''
+  Pause the garbage collector for input of the size (unknown if None)
+  if it's big enough to be worth it.
+  '''
+  collecting = isenabled() and (size is None or size >= GC_PAUSE_SIZE)
+  if collecting:
+    disable()
+  try:
+    yield
+  finally:
+    if collecting:
+      enable()
+
+
+def _reverse(stack, tail=()):
+  while stack:
+    item, stack = stack
+    tail = item, tail
+  return tail
 
 
-class ParseError(ValueError): pass
+def _iter(stack):
+  while stack:
+    item, stack = stack
+    yield item
 
 
-def _tokenize(text):
+_TOKEN = re.compile(r'''\s*(?:
+  (?P<float>-?\d+\.\d*)
+  |(?P<int>-?\d+)
+  |(?P<symbol>[•\w!@$%^&*()_+<>?|\/;:`~,.=-]+)
+  |(?P<open>\[)
+  |(?P<close>\])
+  |(?P<dstr>"(?:[^"\\]|\\.)*")
+  |(?P<sstr>'(?:[^'\\]|\\.)*')
+  )''', re.VERBOSE)
+
+_FLOAT, _INT, _SYMBOL, _OPEN, _CLOSE, _DSTR = range(1, 7)
+
+
+def _parse(chunks):
   '''
-  Convert a text into a stream of tokens, converting symbols using
-  symbol(token).  Raise ValueError (with some of the failing text)
-  if the scan fails.
+  Yield the complete top-level terms of the text in the chunks, as
+  stacks, after each chunk.  A token that runs up to the end of
+  a chunk might continue in the next one, so it's left to be scanned
+  again with that.
   '''
-  tokens, rest = _scanner.scan(text)
-  if rest:
+  frame = ()  # The items of the innermost open list, reversed.
+  frames = ()  # The enclosing open lists' frames.
+  buffer = ''
+  location = _Location()
+  chunks = iter(chunks)
+  chunk = next(chunks, None)
+  while chunk is not None:
+    following = next(chunks, None)
+    frame, frames, buffer = _parse_chunk(
+      frame, frames, buffer, chunk, following is None, location)
+    chunk = following
+    if not frames:
+      yield _reverse(frame)
+      frame = ()
+
+  if frames:
     raise ParseError(
-      'Scan failed at position %i, %r'
-      % (len(text) - len(rest), rest[:10])
-      )
-  return tokens
-
-
-def _parse(tokens):
-  '''
-  Return a stack/list expression of the tokens.
-  '''
-  frame = []
-  stack = []
-  for tok in tokens:
-    if tok == '[':
-      stack.append(frame)
-      frame = []
-      stack[-1].append(frame)
-    elif tok == ']':
-      try:
-        frame = stack.pop()
-      except IndexError:
-        raise ParseError('One or more extra closing brackets.')
-      frame[-1] = list_to_stack(frame[-1])
+      'One or more unclosed brackets.', *location.find(buffer, len(buffer)))
+
+
+def _parse_chunk(frame, frames, buffer, chunk, last, location):
+  '''
+  Parse the chunk (after what's left in the buffer) and return the new
+  frame, frames and buffer.
+  '''
+  buffer = buffer + chunk if buffer else chunk
+  end = len(buffer)
+  previous = None
+
+  scan = _TOKEN.scanner(buffer).match
+  match = scan()
+  while match:
+    if not last and match.end() == end:
+      break
+    kind = match.lastindex
+    if kind == _SYMBOL:
+      frame = Symbol(match.group(kind)), frame
+    elif kind == _INT:
+      frame = int(match.group(kind)), frame
+    elif kind == _OPEN:
+      frames = frame, frames
+      frame = ()
+    elif kind == _CLOSE:
+      if not frames:
+        raise ParseError(
+          'One or more extra closing brackets.',
+          *location.find(buffer, match.end() - 1))
+      frame, (outer, frames) = _reverse(frame), frames
+      frame = frame, outer
+    elif kind == _FLOAT:
+      frame = float(match.group(kind)), frame
+    elif kind == _DSTR:
+      frame = match.group(kind)[1:-1].replace('\\"', '"'), frame
     else:
-      frame.append(tok)
-  if stack:
-    raise ParseError('One or more unclosed brackets.')
-  return list_to_stack(frame)
-
-
-def _scan_identifier(scanner, token): return Symbol(token)
-def _scan_bracket(scanner, token): return token
-def _scan_float(scanner, token): return float(token)
-def _scan_int(scanner, token): return int(token)
-def _scan_dstr(scanner, token): return token[1:-1].replace('\\"', '"')
-def _scan_sstr(scanner, token): return token[1:-1].replace("\\'", "'")
-
-
-_scanner = Scanner([
-  (r'-?\d+\.\d*', _scan_float),
-  (r'-?\d+', _scan_int),
-  (r'[•\w!@$%^&*()_+<>?|\/;:`~,.=-]+', _scan_identifier),
-  (r'\[|\]', _scan_bracket),
-  (r'"(?:[^"\\]|\\.)*"', _scan_dstr),
-  (r"'(?:[^'\\]|\\.)*'", _scan_sstr),
-  (r'\s+', None),
-  ])
+      frame = match.group(kind)[1:-1].replace("\\'", "'"), frame
+    previous = match
+    match = scan()
+
+  if match is not None:
+    pos = match.start()
+  else:
+    pos = previous.end() if previous else 0
+    rest = buffer[pos:].lstrip()
+    # Only an unfinished string might be finished by the next chunk.
+    if rest and (last or rest[0] not in '"\''):
+      raise ParseError(
+        'Scan failed, %r' % (rest[:10],),
+        *location.find(buffer, end - len(rest)))
+  location.consume(buffer, pos)
+  return frame, frames, buffer[pos:]
+
+
+class _Location(object):
+  '''Keep track of the line and column of the start of the buffer.'''
+
+  def __init__(self):
+    self.line = 1
+    self.column = 1
+
+  def find(self, buffer, pos):
+    '''Return the line and column of pos in the buffer.'''
+    last = buffer.rfind('\n', 0, pos)
+    if last < 0:
+      return self.line, self.column + pos
+    return self.line + _newlines(buffer, last + 1), pos - last
+
+  def consume(self, buffer, pos):
+    '''Move the start of the buffer up to pos.'''
+    self.line, self.column = self.find(buffer, pos)
+
+
+def _newlines(buffer, end):
+  '''
+  Return the number of newlines in buffer[:end] without copying it (the
+  buffer can be an mmap.)
+  '''
+  if not isinstance(buffer, mmap):
+    return buffer.count('\n', 0, end)
+  count = 0
+  pos = buffer.find('\n', 0, end)
+  while pos >= 0:
+    count += 1
+    pos = buffer.find('\n', pos + 1, end)
+  return count
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Partial Evaluation
+
+
+Run an expression over a stack we know nothing about, doing everything
+that only depends on literals right now and leaving the rest as a
+residual expression.
+
+The evaluator keeps the items it knows (literals, and the results of
+folding them) on an abstract stack that sits on top of the unknown
+stack.  For each term:
+
+  - Literals are pushed onto the known stack.
+
+  - Simple functions and builtins are applied to the known items if
+    they can be.  We find out by calling them on the known items over a
+    sentinel bottom: if they raise, reach past the known items, or the
+    result refers to the unknown part of the stack, they're not folded.
+
+  - i, x, b, dip, dipd, dipdd and branch are pre-applied when the
+    quotes (and the items they hoist) are known, which just splices the
+    quotes into the expression being processed.
+
+  - A definition is expanded if its whole body folds away, otherwise it
+    stays as a call.
+
+Anything that can't be folded "flushes" the known items into the
+residual as literals followed by the term itself, after which nothing is
+known again.  So, for example:
+
+    [1 2] [3] concat i dup * swap  ->  1 9 2
+    2 3 + swap                     ->  5 swap
+    [sqr] dip                      ->  [sqr] dip
+
+Words that look at or replace the whole stack (stack, clear, unstack,
+swaack, ...) are never folded.
+
+specialize() goes further, since most definitions start with work on
+the stack they're given rather than on literals.  It runs the folded
+body on the translator's symbolic stack (see translator.py) for as long
+as it can be translated and turns that prefix into one Python function;
+the rest of the body is the residual, run after it as usual:
+
+    [sqr] dip                  ->  ([sqr] dip)
+    1 swap [*] step            ->  (1 swap [*]) step
+    unit [down_to_zero] infra  ->  (unit [down_to_zero]) infra
+
+where the parenthesized part is done by the Python function in one
+step.  A definition whose prefix has no words in it just gets its
+folded body, if that's any different.
+
+Folded definitions are copied into the residual, and translated ones
+into their Python functions, so a specialized definition won't see
+later redefinitions of the words it absorbed.  Like those of compiled
+definitions the steps of the prefix aren't seen by a viewer.
+
+Exports:
+
+  SpecializedDefinitionWrapper
+
+  partial_eval(expression, dictionary, max_steps=10000)
+
+  specialize(dictionary, names=None)
+
+'''
+from .library import (
+  BinaryBuiltinWrapper,
+  DefinitionWrapper,
+  FunctionWrapper,
+  SimpleFunctionWrapper,
+  UnaryBuiltinWrapper,
+  b,
+  branch,
+  dip,
+  dipd,
+  dipdd,
+  i,
+  x,
+  )
+from .parser import Symbol
+from .translator import Translation, Translator, Value, code_of, load
+from .utils.stack import (
+  expression_to_string,
+  iter_stack,
+  list_to_stack,
+  pushback,
+  )
+
+
+# Simple functions that don't depend only on the items they unpack.
+UNFOLDABLE = frozenset('clear stack swaack unstack'.split())
+
+
+# How deeply definitions may be expanded inside each other.
+MAX_DEPTH = 32
+
+
+class _Bottom(object):
+  '''Stands for the unknown part of the stack.'''
+  def __repr__(self):
+    return '...'
+
+_BOTTOM = _Bottom()
+
+
+class _Emitted(Exception):
+  '''Raised to abandon a speculative expansion.'''
+
+
+class _PartialEvaluator(object):
+
+  def __init__(self, dictionary, max_steps, known=(), depth=0):
+    self.dictionary = dictionary
+    self.steps = max_steps
+    self.known = list(known)  # Bottom to top.
+    self.residual = []
+    self.depth = depth
+    self.speculative = depth > 0
+
+  def emit(self, term):
+    if self.speculative:
+      raise _Emitted
+    self.flush()
+    self.residual.append(term)
+
+  def flush(self):
+    if self.speculative and self.known:
+      raise _Emitted
+    self.residual.extend(self.known)
+    del self.known[:]
+
+  def run(self, expression):
+    while expression:
+      if self.steps <= 0:
+        for term in iter_stack(expression):
+          self.emit(term)
+        break
+      self.steps -= 1
+      term, expression = expression
+      if isinstance(term, Symbol):
+        expression = self.symbol(term, expression)
+      else:
+        self.known.append(term)
+
+  def symbol(self, term, expression):
+    F = self.dictionary.get(term)
+    kind = F.__class__
+    if (kind is SimpleFunctionWrapper
+        or kind is BinaryBuiltinWrapper
+        or kind is UnaryBuiltinWrapper):
+      if F.name not in UNFOLDABLE and self.fold(F):
+        return expression
+    elif kind is FunctionWrapper and F.f in COMBINATORS:
+      folded = COMBINATORS[F.f](self.known, expression)
+      if folded is not None:
+        return folded
+    elif isinstance(F, DefinitionWrapper) and self.expand(F):
+      return expression
+    self.emit(term)
+    return expression
+
+  def fold(self, F):
+    stack = list_to_stack(self.known[::-1], _BOTTOM)
+    try:
+      stack, _, _ = F(stack, (), self.dictionary)
+    except Exception:
+      return False
+    known = []
+    while isinstance(stack, tuple) and stack:
+      item, stack = stack
+      if isinstance(item, Symbol) or _refers_to(item, _Bottom):
+        return False
+      known.append(item)
+    if stack is not _BOTTOM:
+      return False
+    known.reverse()
+    self.known[:] = known
+    return True
+
+  def expand(self, F):
+    if self.depth >= MAX_DEPTH:
+      return False
+    sub = _PartialEvaluator(
+      self.dictionary, self.steps, self.known, self.depth + 1)
+    try:
+      sub.run(F.body)
+    except _Emitted:
+      return False
+    self.steps = sub.steps
+    self.known[:] = sub.known
+    return True
+
+  def result(self):
+    self.flush()
+    return list_to_stack(self.residual)
+
+
+def _refers_to(item, kind):
+  to_do = [item]
+  while to_do:
+    item = to_do.pop()
+    if isinstance(item, kind):
+      return True
+    if isinstance(item, tuple):
+      to_do.extend(item)
+  return False
+
+
+class SpecializedDefinitionWrapper(DefinitionWrapper):
+  '''
+  A definition whose body begins with a prefix that was translated to the
+  Python function prefix(stack) -> stack.  The residual expression is
+  the rest of the body.
+  '''
+
+  def __init__(
+    self, name, body_text, doc=None, body=None, prefix=None, residual=()):
+    DefinitionWrapper.__init__(self, name, body_text, doc, body)
+    self.prefix = prefix
+    self.residual = residual
+    self._residual = tuple(iter_stack(residual))
+
+  def __call__(self, stack, expression, dictionary):
+    if self.prefix is None:  # E.g. made by F.__class__(name, text).
+      return DefinitionWrapper.__call__(self, stack, expression, dictionary)
+    expression = list_to_stack(self._residual, expression)
+    return self.prefix(stack), expression, dictionary
+
+
+#
+# Pre-application of combinators.  Each takes the known items (bottom to
+# top) and the rest of the expression and returns the new expression,
+# having updated the known items, or None if it can't be done.
+#
+
+
+def _quote(known, index):
+  return len(known) >= index and isinstance(known[-index], tuple)
+
+
+def _i(known, expression):
+  if not _quote(known, 1):
+    return None
+  return pushback(known.pop(), expression)
+
+
+def _x(known, expression):
+  if not _quote(known, 1):
+    return None
+  return pushback(known[-1], expression)
+
+
+def _b(known, expression):
+  if not (_quote(known, 1) and _quote(known, 2)):
+    return None
+  q = known.pop()
+  p = known.pop()
+  return pushback(p, pushback(q, expression))
+
+
+def _dip_n(n):
+  def dip(known, expression):
+    if not _quote(known, 1) or len(known) < n + 1:
+      return None
+    quote = known.pop()
+    items = known[-n:]
+    del known[-n:]
+    return pushback(quote, list_to_stack(items, expression))
+  return dip
+
+
+def _branch(known, expression):
+  if not (_quote(known, 1) and _quote(known, 2) and len(known) >= 3):
+    return None
+  then = known.pop()
+  else_ = known.pop()
+  flag = known.pop()
+  return pushback(then if flag else else_, expression)
+
+
+COMBINATORS = {
+  b: _b,
+  branch: _branch,
+  dip: _dip_n(1),
+  dipd: _dip_n(2),
+  dipdd: _dip_n(3),
+  i: _i,
+  x: _x,
+  }
+
+
+def partial_eval(expression, dictionary, max_steps=10000):
+  '''
+  Return the residual of the expression after folding everything that
+  can be computed without knowing the stack.  max_steps bounds the work
+  done (e.g. for "[dup i] dup i") after which the rest of the expression
+  is left as it is.
+  '''
+  evaluator = _PartialEvaluator(dictionary, max_steps)
+  evaluator.run(expression)
+  return evaluator.result()
+
+
+def _split(body, dictionary):
+  '''
+  Return (prefix, residual) where prefix is a Python function doing what
+  the longest translatable start of the body does and residual is the
+  rest of the body, or None if that start has no words in it.
+  '''
+  translation = Translation()
+  stack = Value(translation, 'stack')
+  stack.depth = 0
+  modules = set()
+  translator = Translator(dictionary, translation, modules)
+  expression, words = body, 0
+  # The last point where the rest of the expression holds no Values,
+  # as quotes with Values in them can be spliced in by i, dip...
+  checkpoint = stack, expression, 0, 0
+  while expression:
+    term, rest = expression
+    if not isinstance(term, Symbol):
+      stack, expression = (term, stack), rest
+    else:
+      try:
+        F = dictionary[term]
+        stack, expression = translator.apply(F, stack, rest, 0)
+      except Exception:  # Untranslatable, or a constant that won't fold.
+        break
+      words += 1
+    if not _refers_to(expression, Value):
+      checkpoint = stack, expression, len(translation.lines), words
+  stack, expression, lines, words = checkpoint
+  del translation.lines[lines:]
+  if not words:
+    return None
+  source = ['def prefix(stack):']
+  source.extend('  ' + line for line in translation.lines)
+  try:
+    source.append('  return %s' % (code_of(stack),))
+  except Exception:  # No literal for an item.
+    return None
+  namespace = load('\n'.join(source), modules, '<specialized>')
+  return namespace['prefix'], expression
+
+
+def specialize(dictionary, names=None):
+  '''
+  Replace definitions in the dictionary with SpecializedDefinitionWrappers
+  of their residuals, where that changes anything, and return the names
+  of the ones replaced.
+  '''
+  if names is None:
+    names = sorted(dictionary)
+  changed = []
+  for name in names:
+    F = dictionary[name]
+    if not isinstance(F, DefinitionWrapper):
+      continue
+    body = partial_eval(F.body, dictionary)
+    split = _split(body, dictionary)
+    if split is None:
+      if body == F.body:
+        continue
+      split = None, body
+    prefix, residual = split
+    dictionary[name] = SpecializedDefinitionWrapper(
+      name,
+      expression_to_string(body),
+      doc=F.__doc__,
+      body=body,
+      prefix=prefix,
+      residual=residual,
+      )
+    changed.append(name)
+  return changed
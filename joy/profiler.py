@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Profiling
+
+
+A viewer sees every step but it doesn't know where a word's work ends:
+a definition, or a combinator like dip, just puts more terms on the
+pending expression and returns.  The Profiler evaluates expressions
+itself and, whenever a word puts terms on the expression, it puts an
+exit marker after them.  When the marker comes up the word is done, so
+a call to a word lasts from when it's looked up until its marker, and
+that includes everything the terms it pushed did.
+
+For each word it records the number of calls, the exclusive time (spent
+in the word itself, and pushing the literals in its body) and the
+inclusive time (including the words it called.)  It also records the
+same for each caller -> callee edge, with the expression you ran as the
+root caller "<expression>".
+
+Recursion is handled like the Python profilers do: the inclusive time
+of a word only counts its outermost call.  A word that calls itself as
+the very last thing it does (loop, times, genrec and tail-recursive
+definitions) doesn't get a new marker, so a long loop doesn't build up
+a long pile of them.
+
+Definitions are always run from their _body, so a compiled (or
+otherwise optimized) definition is profiled as its reference version.
+
+  profiler = Profiler()
+  stack, _, dictionary = profiler.run('10 fib', stack, dictionary)
+  profiler.print_()
+  profiler.dump_stats('fib.prof')  # For pstats, snakeviz, etc.
+
+Exports:
+
+  Profiler(timer=default_timer)
+
+'''
+from __future__ import print_function
+from marshal import dump
+from timeit import default_timer
+from .library import DefinitionWrapper
+from .parser import text_to_expression, ParseError, Symbol
+from .utils.stack import list_to_stack
+
+
+ROOT = '<expression>'
+
+
+class _Exit(object):
+  '''The marker at the end of the terms a word pushed.'''
+  def __repr__(self):
+    return '<exit>'
+
+_EXIT = _Exit()
+
+
+def _mark(expression, rest):
+  '''
+  Return expression with _EXIT put in front of rest, or None if rest
+  isn't the tail of expression.
+  '''
+  terms = []
+  while expression is not rest:
+    if not expression:
+      return None
+    term, expression = expression
+    terms.append(term)
+  return list_to_stack(terms, (_EXIT, rest))
+
+
+class Profiler(object):
+  '''
+  Evaluate Joy expressions while timing the words in them.  The
+  counts accumulate over every call to joy() or run().
+  '''
+
+  def __init__(self, timer=default_timer):
+    self.timer = timer
+    # name -> [primitive calls, calls, exclusive time, inclusive time]
+    self.words = {}
+    # (caller, callee) -> [primitive calls, calls, exclusive, inclusive]
+    self.edges = {}
+    self._frames = []  # [name, caller, start time, outermost] items.
+    self._active = {}  # name -> how many of its frames are open.
+    self._last = None
+
+  def run(self, text, stack, dictionary):
+    '''
+    Return the stack resulting from running the Joy code text on the
+    stack.
+    '''
+    try:
+      expression = text_to_expression(text)
+    except ParseError as err:
+      print('Err:', err.message)
+      return stack, (), dictionary
+    return self.joy(stack, expression, dictionary)
+
+  def joy(self, stack, expression, dictionary):
+    '''
+    Evaluate the Joy expression on the stack.
+    '''
+    timer = self.timer
+    depth = len(self._frames)
+    self._last = timer()
+    self._enter(ROOT, self._last)
+    try:
+      while expression:
+        term, expression = expression
+
+        if term is _EXIT:
+          self._exit(timer())
+          continue
+
+        if not isinstance(term, Symbol):
+          stack = term, stack
+          continue
+
+        F = dictionary[term]
+        tail = expression and expression[0] is _EXIT
+        if tail and self._frames[-1][0] == F.name:
+          self._count(F.name, self._frames[-1][1], False)
+          if isinstance(F, DefinitionWrapper):
+            expression = list_to_stack(F._body, expression)
+          else:
+            stack, expression, dictionary = F(stack, expression, dictionary)
+          continue
+
+        self._enter(F.name, timer())
+        if isinstance(F, DefinitionWrapper):
+          expression = list_to_stack(F._body, (_EXIT, expression))
+          continue
+        rest = expression
+        stack, expression, dictionary = F(stack, expression, dictionary)
+        marked = None if expression is rest else _mark(expression, rest)
+        if marked is None:
+          self._exit(timer())
+        else:
+          expression = marked
+
+    finally:
+      now = timer()
+      while len(self._frames) > depth:
+        self._exit(now)
+    return stack, (), dictionary
+
+  def _count(self, name, caller, primitive):
+    for counts in (
+      self.words.setdefault(name, [0, 0, 0.0, 0.0]),
+      self.edges.setdefault((caller, name), [0, 0, 0.0, 0.0]),
+      ):
+      counts[0] += primitive
+      counts[1] += 1
+
+  def _tick(self, now):
+    '''Charge the time since the last event to the current word.'''
+    if self._frames:
+      name, caller, _, _ = self._frames[-1]
+      elapsed = now - self._last
+      self.words[name][2] += elapsed
+      self.edges[caller, name][2] += elapsed
+    self._last = now
+
+  def _enter(self, name, now):
+    self._tick(now)
+    caller = self._frames[-1][0] if self._frames else ''
+    outermost = not self._active.get(name)
+    self._count(name, caller, outermost)
+    self._active[name] = self._active.get(name, 0) + 1
+    self._frames.append([name, caller, now, outermost])
+
+  def _exit(self, now):
+    self._tick(now)
+    name, caller, start, outermost = self._frames.pop()
+    self._active[name] -= 1
+    if outermost:
+      self.words[name][3] += now - start
+      self.edges[caller, name][3] += now - start
+
+  def create_stats(self):
+    '''
+    Make the stats attribute that pstats.Stats() looks for, so you can
+    pass a Profiler to it directly.
+    '''
+    callers = dict((name, {}) for name in self.words)
+    for (caller, name), (primitive, calls, exclusive, inclusive) in (
+      self.edges.iteritems()):
+      if caller:  # pstats wants calls before primitive calls here.
+        callers[name][_function(caller)] = (
+          calls, primitive, exclusive, inclusive)
+    self.stats = dict(
+      (_function(name), tuple(counts) + (callers[name],))
+      for name, counts in self.words.iteritems()
+      )
+
+  def dump_stats(self, filename):
+    '''Write the stats to a file that pstats.Stats() can read.'''
+    self.create_stats()
+    with open(filename, 'wb') as f:
+      dump(self.stats, f)
+
+  def report(self, sort='exclusive', limit=None):
+    '''
+    Return a text table of the words, sorted by 'exclusive' or
+    'inclusive' time or by 'calls'.
+    '''
+    column = {'calls': 1, 'exclusive': 2, 'inclusive': 3}[sort]
+    rows = sorted(
+      self.words.items(),
+      key=lambda (name, counts): counts[column],
+      reverse=True,
+      )
+    if limit is not None:
+      rows = rows[:limit]
+    lines = ['%10s %12s %12s %12s  %s' % (
+      'calls', 'exclusive', 'inclusive', 'incl/call', 'word')]
+    for name, (_, calls, exclusive, inclusive) in rows:
+      lines.append('%10i %12.6f %12.6f %12.6f  %s' % (
+        calls, exclusive, inclusive, inclusive / calls, name))
+    return '\n'.join(lines)
+
+  def print_(self, sort='exclusive', limit=None):
+    print(self.report(sort, limit))
+
+
+def _function(name):
+  '''The (filename, line, name) triple pstats uses to name functions.'''
+  return 'joy', 0, name
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Sampling Profiler
+
+
+The Profiler in profiler.py sees every step, which slows down every
+step.  The Sampler instead runs in a thread of its own and every so
+often looks at the Python stack of the thread doing the evaluation
+(with sys._current_frames()) and reads the local variables of the
+evaluators it finds there.  The evaluation itself runs at full speed.
+
+From joy(), budgeted_joy() and frame_joy() it gets the word being run.
+frame_joy() also keeps the unevaluated tails of the definitions it's in
+as its frames, and since those are the very cons cells of the bodies
+(nothing is copied) the Sampler can tell which definitions they belong
+to, giving the chain of active definitions.  Evaluators called from
+inside words (e.g. by the native combinators) are stacked on top of the
+ones that called them.
+
+Each sample is counted under its chain, outermost first, in the folded
+format that flamegraph.pl and speedscope read:
+
+  <expression>;fib;fib;fib;ifte 42
+
+The Sampler also reads the step counters of frame_joy() and of
+budgeted_joy() (give it a Budget with no limits) and can write the
+steps per second to a stream every second or so.
+
+  with Sampler(dictionary, readout=sys.stderr) as sampler:
+    frame_joy(stack, expression, dictionary)
+  sampler.write_folded('joy.folded')
+
+Exports:
+
+  Sampler(dictionary, interval=0.005, thread=None, readout=None)
+
+'''
+from collections import Counter
+from sys import _current_frames
+from threading import Event, Thread, current_thread
+from time import time
+from .budget import budgeted_joy
+from .frames import frame_joy
+from .joy import joy
+from .library import DefinitionWrapper
+from .parser import Symbol
+from .utils.stack import iter_stack
+
+
+ROOT = '<expression>'
+
+
+_EVALUATORS = {
+  joy.__code__: 'joy',
+  budgeted_joy.__code__: 'budgeted_joy',
+  frame_joy.__code__: 'frame_joy',
+  }
+
+
+def _index_definitions(dictionary):
+  '''
+  Return a dict mapping the ids of the cons cells in the bodies of the
+  definitions (and in the quotes in them) to the names of the
+  definitions.
+  '''
+  index = {}
+  for name, F in dictionary.items():
+    if not isinstance(F, DefinitionWrapper):
+      continue
+    to_do = [F.body]
+    while to_do:
+      cell = to_do.pop()
+      while cell:
+        index.setdefault(id(cell), name)
+        term, cell = cell
+        if isinstance(term, tuple):
+          to_do.append(term)
+  return index
+
+
+class Sampler(object):
+  '''
+  Sample what a thread (by default the one that creates the Sampler)
+  is evaluating every interval seconds between start() and stop().
+  '''
+
+  def __init__(self, dictionary, interval=0.005, thread=None, readout=None,
+               readout_interval=1.0):
+    self.interval = interval
+    self.thread = current_thread() if thread is None else thread
+    self.readout = readout
+    self.readout_interval = readout_interval
+    self.dictionary = dictionary
+    self.samples = Counter()
+    self.steps = 0
+    self.steps_per_second = 0.0
+    self._index = _index_definitions(dictionary)
+    self._stopped = Event()
+    self._sampler = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  def start(self):
+    self._stopped.clear()
+    self._sampler = Thread(target=self._run, name='joy sampler')
+    self._sampler.daemon = True
+    self._sampler.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._sampler is not None:
+      self._sampler.join()
+      self._sampler = None
+
+  def _run(self):
+    ident = self.thread.ident
+    last_time, last_steps = time(), None
+    while not self._stopped.wait(self.interval):
+      frame = _current_frames().get(ident)
+      if frame is None:
+        continue
+      chain, steps = self.sample(frame)
+      del frame
+      if chain:
+        self.samples[';'.join(chain)] += 1
+      now = time()
+      if steps is not None:
+        self.steps = steps
+      if now - last_time >= self.readout_interval:
+        if last_steps is not None and self.steps >= last_steps:
+          self.steps_per_second = (
+            (self.steps - last_steps) / (now - last_time))
+          if self.readout:
+            self.readout.write(
+              '%12.0f steps/s\n' % (self.steps_per_second,))
+            self.readout.flush()
+        last_time, last_steps = now, self.steps
+
+  def sample(self, frame):
+    '''
+    Return the chain of words active in the Python frame (outermost
+    first) and the step count of the outermost evaluator that has one.
+    '''
+    evaluators = []
+    while frame is not None:
+      kind = _EVALUATORS.get(frame.f_code)
+      if kind:
+        evaluators.append((kind, frame.f_locals))
+      frame = frame.f_back
+    if not evaluators:
+      return [], None
+    chain = [ROOT]
+    steps = None
+    for kind, local in reversed(evaluators):
+      if kind == 'frame_joy':
+        frames = local.get('frames', ())
+        names = [
+          self._index.get(id(segment))
+          for segment in iter_stack(frames)
+          ]
+        chain.extend(name for name in reversed(names) if name)
+        if steps is None:
+          steps = local.get('steps')
+      elif kind == 'budgeted_joy' and steps is None:
+        budget = local.get('budget')
+        if budget is not None:
+          steps = budget.steps + local.get('taken', 0)
+      term = local.get('term')  # In joy() it becomes the function.
+      if isinstance(term, Symbol):
+        term = self.dictionary.get(term, term)  # For its name.
+      if isinstance(term, Symbol):
+        name = str(term)
+      else:
+        name = getattr(term, 'name', None)
+      if isinstance(name, str):
+        chain.append(name)
+    return chain, steps
+
+  def folded(self):
+    '''Return the samples in the folded stack format, one per line.'''
+    return '\n'.join(
+      '%s %i' % (chain, count)
+      for chain, count in sorted(self.samples.iteritems())
+      )
+
+  def write_folded(self, filename):
+    with open(filename, 'w') as f:
+      f.write(self.folded())
+      f.write('\n')
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Evaluation Server
+
+
+An HTTP server that runs Joy programs for other processes.  POST a JSON
+object to /eval:
+
+  {"program": "[dup *] map", "stack": "[1 2 3]", "steps": 100000}
+
+and get back
+
+  {"ok": true, "stack": "[1 4 9]", "steps": 9}
+
+The stack is written as the REPL prints it, top on the right, and is
+empty if left out.  "steps" is the most steps the program may take (see
+budget.py) and "timeout" the most seconds; they can be less than the
+server's max_steps and timeout but not more.  A program that fails gets
+back
+
+  {"ok": false, "error": "ZeroDivisionError: ...", "steps": 2}
+
+and one that runs out of budget also gets "reason" ("steps",
+"deadline"...) and the "stack" it got to.  POST a list of such objects
+to get a list of the answers, in the same order.  GET /stats for the
+counts of requests, errors and steps, the requests per second and the
+latencies (the mean and 50th, 90th and 99th percentiles, in seconds, of
+the last LATENCY_WINDOW requests.)
+
+The programs are run by worker processes forked with the dictionary the
+server was made with, so they're ready to go.  Each request waits in a
+queue for at most batch_wait seconds to be sent to a worker along with
+any other requests that come in meanwhile (up to batch_size of them) so
+that when there are many small requests they cost one trip to a worker
+per batch rather than one each.  The workers evaluate with
+budgeted_joy() so the programs run in the same dictionary never change
+it for the next.
+
+Each worker has a thread in the server that sends it its batches and
+gets back the answers one at a time, as they're ready.  If a request
+has been running for HANDOFF seconds the rest of its batch is put back
+on the queue for the other workers as well (whichever answer comes
+first is used, the programs don't change anything.)  A program that
+is still running KILL_GRACE seconds past its timeout (in a word that
+doesn't come back to the evaluator, like a huge pow or a sleep) has its
+worker killed and replaced, and gets back reason "deadline" without a
+stack; if a worker dies the program it was running gets back an error.
+No request waits more than max_wait seconds for its answer, however
+busy the workers are.
+
+The server only listens on localhost by default.
+
+  server = Server(initialize(), ('127.0.0.1', 8000))
+  server.serve_forever()  # Or server.start() to run it in a thread.
+
+  evaluate(('127.0.0.1', 8000), '1 2 +')  ->  {"ok": true, ...}
+
+or from the shell:
+
+  python -m joy.server [port]
+
+Exports:
+
+  HANDOFF
+
+  KILL_GRACE
+
+  LATENCY_WINDOW
+
+  Server(dictionary, address=('127.0.0.1', 0), processes=None,
+         max_steps=1000000, timeout=10.0, batch_size=32, batch_wait=0.002,
+         max_wait=60.0)
+
+  Stats
+
+  evaluate(address, program, stack='', steps=None, timeout=None)
+
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from httplib import HTTPConnection
+import json
+from multiprocessing import Pipe, Process, cpu_count
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+from sys import argv
+from threading import Event, Lock, Thread
+from time import time
+from .budget import Budget, BudgetExceeded, budgeted_joy
+from .parser import text_to_expression
+from .utils.stack import iter_stack, list_to_stack, stack_to_string
+
+
+# How many of the latest requests the latencies are taken from.
+LATENCY_WINDOW = 10000
+
+# How long a request may run before the rest of its batch is put back on
+# the queue, in seconds.
+HANDOFF = 0.05
+
+# How long past its timeout a program may run before its worker is
+# killed, in seconds.
+KILL_GRACE = 1.0
+
+
+#
+# § In the workers.
+#
+
+
+_worker_dictionary = None
+
+
+def _start_worker(dictionary):
+  global _worker_dictionary
+  _worker_dictionary = dictionary
+
+
+def _work(connection, dictionary):
+  '''The loop of a worker process: answer batches of requests.'''
+  _start_worker(dictionary)
+  while True:
+    try:
+      batch = connection.recv()
+    except EOFError:  # The server has gone.
+      return
+    for request in batch:
+      try:
+        answer = _evaluate(*request)
+      except Exception as err:  # E.g. a stack too deep to print.
+        answer = {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+      answer.setdefault('steps', 0)
+      connection.send(answer)
+
+
+def _evaluate(program, stack, max_steps, timeout):
+  '''Return the answer (a dict) to one request.'''
+  budget = Budget(max_steps, timeout)
+  try:
+    expression = text_to_expression(program)
+    stack = list_to_stack(list(iter_stack(text_to_expression(stack)))[::-1])
+    stack, _, _ = budgeted_joy(stack, expression, _worker_dictionary, budget)
+  except BudgetExceeded as err:
+    return {
+      'ok': False,
+      'error': str(err),
+      'reason': err.reason,
+      'stack': stack_to_string(err.stack),
+      'steps': budget.steps,
+      }
+  except Exception as err:
+    return {
+      'ok': False,
+      'error': '%s: %s' % (type(err).__name__, err),
+      'steps': budget.steps,
+      }
+  return {'ok': True, 'stack': stack_to_string(stack), 'steps': budget.steps}
+
+
+#
+# § Statistics.
+#
+
+
+class Stats(object):
+  '''Counts and latencies of the requests a Server has answered.'''
+
+  def __init__(self):
+    self.started = time()
+    self.requests = self.errors = self.budget_exceeded = 0
+    self.batches = self.steps = 0
+    self.latencies = deque(maxlen=LATENCY_WINDOW)
+    self._lock = Lock()
+
+  def add_batch(self, answers, latencies, batches=1):
+    with self._lock:
+      self.batches += batches
+      self.requests += len(answers)
+      for answer in answers:
+        self.steps += answer['steps']
+        if not answer['ok']:
+          self.errors += 1
+          if 'reason' in answer:
+            self.budget_exceeded += 1
+      self.latencies.extend(latencies)
+
+  def report(self):
+    '''Return the statistics as a dict.'''
+    with self._lock:
+      latencies = sorted(self.latencies)
+      elapsed = time() - self.started
+      report = {
+        'requests': self.requests,
+        'errors': self.errors,
+        'budget_exceeded': self.budget_exceeded,
+        'steps': self.steps,
+        'batches': self.batches,
+        'mean_batch_size':
+          float(self.requests) / self.batches if self.batches else 0.0,
+        'uptime': elapsed,
+        'requests_per_second': self.requests / elapsed if elapsed else 0.0,
+        'steps_per_second': self.steps / elapsed if elapsed else 0.0,
+        }
+    report['latency'] = _percentiles(latencies)
+    return report
+
+
+def _percentiles(latencies):
+  if not latencies:
+    return {}
+  def at(fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+  return {
+    'mean': sum(latencies) / len(latencies),
+    'p50': at(0.5),
+    'p90': at(0.9),
+    'p99': at(0.99),
+    'max': latencies[-1],
+    }
+
+
+#
+# § The server.
+#
+
+
+class _Request(object):
+  '''A request waiting for its answer.'''
+
+  def __init__(self, arguments):
+    self.arguments = arguments
+    self.arrived = time()
+    self.answer = None
+    self.answered = Event()
+    self._lock = Lock()
+
+  def give(self, answer):
+    '''
+    Answer the request, if it hasn't been already, and return True if
+    this is its answer.
+    '''
+    with self._lock:
+      if self.answered.is_set():
+        return False
+      self.answer = answer
+      self.answered.set()
+      return True
+
+
+class _Worker(object):
+  '''A worker process and our end of its pipe.'''
+
+  def __init__(self, dictionary):
+    self.connection, theirs = Pipe()
+    # Forked, so it gets the dictionary as it is now.
+    self.process = Process(
+      target=_work, args=(theirs, dictionary), name='joy worker')
+    self.process.daemon = True
+    self.process.start()
+    theirs.close()
+
+  def kill(self):
+    self.process.terminate()
+    self.process.join()
+    self.connection.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path != '/stats':
+      return self.send_error(404)
+    self._reply(200, self.server.stats.report())
+
+  def do_POST(self):
+    if self.path != '/eval':
+      return self.send_error(404)
+    try:
+      body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      requests = body if isinstance(body, list) else [body]
+      arguments = map(self.server.arguments, requests)
+    except (TypeError, ValueError, KeyError) as err:
+      return self._reply(400, {'ok': False, 'error': str(err)})
+    answers = self.server.submit(arguments)
+    self._reply(200, answers if isinstance(body, list) else answers[0])
+
+  def _reply(self, code, thing):
+    data = json.dumps(thing)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass  # The stats are the log.
+
+
+class Server(ThreadingMixIn, HTTPServer):
+  '''
+  Serve requests to evaluate Joy programs with the dictionary.  The
+  default address picks a free port on localhost; see server_address.
+  '''
+
+  daemon_threads = True
+  protocol_version = 'HTTP/1.1'
+
+  def __init__(
+    self,
+    dictionary,
+    address=('127.0.0.1', 0),
+    processes=None,
+    max_steps=1000000,
+    timeout=10.0,
+    batch_size=32,
+    batch_wait=0.002,
+    max_wait=60.0,
+    ):
+    self.max_steps = max_steps
+    self.timeout = timeout
+    self.batch_size = batch_size
+    self.batch_wait = batch_wait
+    self.max_wait = max_wait
+    self.stats = Stats()
+    self._queue = Queue()
+    # The workers are forked now, with the dictionary as it is.
+    self._dictionary = dictionary
+    self._workers = [
+      _Worker(dictionary) for _ in xrange(processes or cpu_count())]
+    self._closing = False
+    for index in xrange(len(self._workers)):
+      feeder = Thread(
+        target=self._feed, args=(index,), name='joy feeder %i' % index)
+      feeder.daemon = True
+      feeder.start()
+    self._thread = None
+    HTTPServer.__init__(self, address, _Handler)
+
+  def arguments(self, request):
+    '''Return the arguments of _evaluate() for a request (a dict.)'''
+    program = request['program']
+    stack = request.get('stack', '')
+    if not isinstance(program, basestring) or not isinstance(
+      stack, basestring):
+      raise TypeError('The program and the stack must be strings.')
+    if isinstance(program, unicode):  # JSON strings are all unicode.
+      program = program.encode('utf-8')
+    if isinstance(stack, unicode):
+      stack = stack.encode('utf-8')
+    steps = _lower(request.get('steps'), self.max_steps)
+    timeout = _lower(request.get('timeout'), self.timeout)
+    return program, stack, steps, timeout
+
+  def submit(self, arguments):
+    '''
+    Queue the requests (tuples of arguments) and return their answers
+    when they've all been answered, or max_wait has passed.
+    '''
+    requests = map(_Request, arguments)
+    for request in requests:
+      self._queue.put(request)
+    deadline = None if self.max_wait is None else time() + self.max_wait
+    for request in requests:
+      if request.answered.wait(
+        None if deadline is None else max(0, deadline - time())):
+        continue
+      answer = {
+        'ok': False,
+        'error': 'No answer within %s seconds.' % (self.max_wait,),
+        'steps': 0,
+        }
+      if request.give(answer):
+        self.stats.add_batch([answer], [time() - request.arrived], 0)
+    return [request.answer for request in requests]
+
+  def _take_batch(self):
+    '''Return the next batch of requests from the queue, or None.'''
+    batch = []
+    deadline = None
+    while len(batch) < self.batch_size:
+      try:
+        request = self._queue.get(
+          timeout=None if deadline is None else max(0, deadline - time()))
+      except Empty:
+        break
+      if request is None:  # Closing.
+        return None
+      if request.answered.is_set():  # Answered elsewhere, or given up on.
+        continue
+      batch.append(request)
+      if deadline is None:
+        deadline = time() + self.batch_wait
+    return batch
+
+  def _feed(self, index):
+    '''Send batches from the queue to a worker, replacing it if need be.'''
+    while True:
+      batch = self._take_batch()
+      if batch is None:
+        return
+      if not self._run_batch(self._workers[index], batch):
+        if self._closing:
+          return
+        self._workers[index] = _Worker(self._dictionary)
+
+  def _run_batch(self, worker, batch):
+    '''
+    Send the batch to the worker and answer its requests.  Return False
+    if the worker died or had to be killed.
+    '''
+    try:
+      worker.connection.send([request.arguments for request in batch])
+      alive = True
+    except IOError:  # It died between batches.
+      worker.kill()
+      alive = False
+    answers, latencies = [], []
+    done = 0  # How many of the batch have been answered by the worker.
+    handed_off = False
+    while alive and done < len(batch):
+      request = batch[done]
+      done += 1
+      if (done < len(batch)
+          and not handed_off
+          and not worker.connection.poll(HANDOFF)):
+        for other in batch[done:]:
+          self._queue.put(other)
+        handed_off = True
+      answer, alive = self._answer(worker, request)
+      if request.give(answer):
+        answers.append(answer)
+        latencies.append(time() - request.arrived)
+    if not handed_off:
+      for request in batch[done:]:  # If the worker is gone.
+        self._queue.put(request)
+    if answers:
+      self.stats.add_batch(answers, latencies)
+    return alive
+
+  def _answer(self, worker, request):
+    '''
+    Return the worker's answer to the request it's running and whether
+    the worker is still alive, killing it if it runs KILL_GRACE seconds
+    past its timeout.
+    '''
+    timeout = request.arguments[3]
+    if timeout is not None:
+      timeout += KILL_GRACE
+    try:
+      if worker.connection.poll(timeout):
+        return worker.connection.recv(), True
+    except (EOFError, IOError):
+      worker.kill()
+      return {
+        'ok': False,
+        'error': 'The worker running the program died.',
+        'steps': 0,
+        }, False
+    worker.kill()
+    return {
+      'ok': False,
+      'error': 'Budget exceeded: deadline',
+      'reason': 'deadline',
+      'steps': 0,
+      }, False
+
+  def start(self):
+    '''Serve in a thread of its own.'''
+    self._thread = Thread(target=self.serve_forever, name='joy server')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def close(self):
+    '''Stop serving and stop the workers.'''
+    if self._thread is not None:
+      self.shutdown()
+      self._thread = None
+    self.server_close()
+    self._closing = True
+    for worker in self._workers:
+      self._queue.put(None)
+      worker.kill()
+
+
+def _lower(limit, server_limit):
+  if limit is None:
+    return server_limit
+  if not isinstance(limit, (int, long, float)):
+    raise TypeError('Limits must be numbers.')
+  return limit if server_limit is None else min(limit, server_limit)
+
+
+def evaluate(address, program, stack='', steps=None, timeout=None):
+  '''
+  Ask the server at the address to run the program on the stack (both
+  as text) and return its answer.
+  '''
+  request = {'program': program, 'stack': stack}
+  if steps is not None:
+    request['steps'] = steps
+  if timeout is not None:
+    request['timeout'] = timeout
+  connection = HTTPConnection(*address)
+  try:
+    connection.request(
+      'POST', '/eval', json.dumps(request),
+      {'Content-Type': 'application/json'})
+    return json.loads(connection.getresponse().read())
+  finally:
+    connection.close()
+
+
+if __name__ == '__main__':
+  from .library import initialize
+  server = Server(
+    initialize(), ('127.0.0.1', int(argv[1]) if len(argv) > 1 else 8000))
+  print('Serving on http://%s:%i/' % server.server_address)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Dictionary Snapshots
+
+
+initialize() parses the library's definitions every time it's called,
+and a program that adds its own sets of definitions on top parses those
+too.  For a short-lived process that can take longer than the work it
+does.
+
+  dictionary = load_snapshot('joy.snapshot', [my_definitions])
+
+gives the same dictionary as
+
+  dictionary = initialize()
+  DefinitionWrapper.add_definitions(my_definitions, dictionary)
+
+but the first time it also writes the parsed definitions to the file
+(with serialize.py) and after that it reads them from there instead of
+parsing them again.  The file starts with a hash of the texts of the
+definitions (the library's and the ones passed in, in order) and the
+versions of the formats, so if any of them changes the file is ignored,
+the dictionary is built the slow way, and the file is written again.  A
+file that can't be read is treated the same way, and if the file can't
+be written the dictionary is returned anyway.  A dictionary with a
+definition the serializer can't write (one holding a Python object
+other than the kinds it knows, say) isn't saved.
+
+With lazy true the definitions are LazyDefinitionWrappers (see
+library.py) made from their texts, which are kept in the file too, so
+they're still only parsed when they're first used.  Saving doesn't
+materialize lazy definitions that haven't been.
+
+Only the definitions are kept in the file.  The words written in Python
+are put in the dictionary from the library as usual, so changes to them
+don't need a new snapshot, and words you add from Python (like the ones
+in docs/repl.py) have to be added after loading, as before.
+
+Exports:
+
+  load_snapshot(filename, definition_sets=(), compiled=False, lazy=False)
+
+  save_snapshot(filename, dictionary, definition_sets=())
+
+'''
+from hashlib import sha1
+from os import remove, rename
+from os.path import abspath, dirname
+from tempfile import NamedTemporaryFile
+from . import library
+from .library import (
+  DefinitionWrapper,
+  LazyDefinitionWrapper,
+  _add_functions,
+  definition_wrapper,
+  )
+from .linker import Dictionary
+from .utils import serialize
+from .utils.stack import expression_to_string, iter_stack, list_to_stack
+
+
+VERSION = 2
+
+
+def _key(definition_sets):
+  '''Return the hash of everything the definitions come from.'''
+  h = sha1('joy snapshot %i %i\0' % (VERSION, serialize.VERSION))
+  for text in (library.definitions,) + tuple(definition_sets):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    h.update('%i\0%s' % (len(text), text))
+  return h.hexdigest()
+
+
+def _build(definition_sets, compiled, lazy):
+  dictionary = library.initialize(compiled=compiled, lazy=lazy)
+  wrapper = definition_wrapper(compiled, lazy)
+  for definitions in definition_sets:
+    wrapper.add_definitions(definitions, dictionary)
+  return dictionary
+
+
+def load_snapshot(filename, definition_sets=(), compiled=False, lazy=False):
+  '''
+  Return a dictionary initialized with the library and the texts of
+  definitions in definition_sets, reading the definitions from the
+  snapshot file if it's up to date, and writing it if it isn't.
+  '''
+  definition_sets = tuple(definition_sets)
+  key = _key(definition_sets)
+  try:
+    with open(filename, 'rb') as f:
+      if serialize.load(f) == key:
+        return _from_entries(serialize.load(f), compiled, lazy)
+  except (IOError, OSError, EOFError, ValueError, TypeError):
+    pass
+  dictionary = _build(definition_sets, compiled, lazy)
+  try:
+    _write(filename, key, dictionary)
+  except (IOError, OSError, TypeError):
+    pass
+  return dictionary
+
+
+def save_snapshot(filename, dictionary, definition_sets=()):
+  '''
+  Write the definitions in the dictionary to the snapshot file for the
+  definition_sets.  (The dictionary should be the one they make, but
+  that isn't checked.)  Return False, leaving any old file alone, if a
+  definition can't be serialized.
+  '''
+  try:
+    _write(filename, _key(tuple(definition_sets)), dictionary)
+  except TypeError:
+    return False
+  return True
+
+
+def _write(filename, key, dictionary):
+  entries = list_to_stack([
+    _entry(name, F)
+    for name, F in sorted(dictionary.iteritems())
+    if isinstance(F, DefinitionWrapper)
+    ])
+  # Write it next to the file and then rename it, so that a process
+  # reading the snapshot never sees half of it.
+  f = NamedTemporaryFile(
+    dir=dirname(abspath(filename)), prefix='.snapshot', delete=False)
+  try:
+    with f:
+      serialize.dump(key, f)
+      serialize.dump(entries, f)
+    try:
+      rename(f.name, filename)
+    except OSError:  # Windows won't rename over a file.
+      remove(filename)
+      rename(f.name, filename)
+  except:
+    remove(f.name)
+    raise
+
+
+def _entry(key, F):
+  '''
+  Return the entry for the definition: its key, name, doc, body text
+  and, unless it's lazy and hasn't been parsed, its body.
+  '''
+  doc = F.__doc__ or ''
+  if not isinstance(F, LazyDefinitionWrapper):
+    text = expression_to_string(F.body)
+  elif F.materialized:
+    text = F.body_text
+  else:
+    return list_to_stack((key, F.name, doc, F.body_text))
+  return list_to_stack((key, F.name, doc, text, F.body))
+
+
+def _from_entries(entries, compiled, lazy):
+  wrapper = definition_wrapper(compiled, lazy)
+  dictionary = Dictionary()
+  _add_functions(dictionary)
+  for entry in iter_stack(entries):
+    entry = tuple(iter_stack(entry))
+    key, name, doc, text = entry[:4]
+    body = entry[4] if len(entry) > 4 and not lazy else None
+    dictionary[key] = wrapper(name, text, doc, body)
+  return dictionary
@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Translating Definitions to Python
+
+
+Straight-line definitions like "second == rest first" or "sqr == dup mul"
+can be written as ordinary Python functions on (head, tail) tuples, just
+like the hand-written primitives in the library.  This module does that
+for you.
+
+It works by running the definition symbolically.  The stack starts out
+as an unknown Value called "stack".  Destructuring a Value, e.g.
+
+  (tos, (second, stack)) = S
+
+emits the assignment "(v1, v2) = stack" and gives back two new Values,
+so the Python functions of the simple primitives can be run unchanged on
+symbolic stacks; arithmetic on Values emits a temporary variable for the
+result.  That only works for the primitives in PRIMITIVES, which just
+take apart and put together cons cells and use operators (or, like
+concat, only look at types where the result would be the same anyway.)
+The others look at the types of the items (to treat a Vector
+differently from a list, say) and would silently take the wrong branch
+for a Value, so a definition that uses one of them isn't translated.
+
+Literals stay literals, and anything computed from literals alone is
+computed right away.  i, x, b, dip, dipd, dipdd, dupdip and infra are
+inlined when their quotes are literals, and definitions are inlined
+into each other.
+
+A definition that needs anything else (a Boolean decision, a loop, a
+combinator on a quote only known at runtime...) can't be translated and
+is skipped.
+
+The stack effect of a translated definition is the number of items it
+takes from the stack and the number it leaves in their place, e.g.
+swons is (2, 1).  It's None for things like clear that don't leave the
+rest of the stack alone.
+
+§ Symbolic Evaluation
+
+The machinery is public so that other modules can run quotes
+symbolically for their own ends (vectorize.py compiles loops with it,
+partial.py the prefixes of definitions, and optimizer.py proves its
+rules with it):
+
+  translation = Translation()
+  stack = Value(translation, 'stack')
+  result = Translator(dictionary, translation, modules).run(stack, quote)
+
+leaves in translation.lines the Python statements computing result
+from stack, and in the set modules the names of the modules they use;
+code_of(result) is the Python expression for the result, and load()
+runs source built from those and returns the namespace it defined.
+
+Exports:
+
+  PRIMITIVES
+
+  Translation()
+
+  Translator(dictionary, translation, modules, primitives=PRIMITIVES)
+
+  Untranslatable
+
+  Value(translation, name)
+
+  code_of(thing)
+
+  load(source, modules, filename='<translated>')
+
+  infer_stack_effect(F, dictionary)
+
+  translate(F, dictionary)
+
+  generate_module(dictionary, names=None)
+
+  write_module(filename, dictionary, names=None)
+
+'''
+from keyword import iskeyword
+import re
+import sys
+
+from .library import (
+  BinaryBuiltinWrapper,
+  DefinitionWrapper,
+  FunctionWrapper,
+  SimpleFunctionWrapper,
+  UnaryBuiltinWrapper,
+  b,
+  choice,
+  clear,
+  concat,
+  cons,
+  dip,
+  dipd,
+  dipdd,
+  drop,
+  dup,
+  dupd,
+  dupdip,
+  first,
+  i,
+  id_,
+  infra,
+  over,
+  pm,
+  pop,
+  popd,
+  popdd,
+  popop,
+  pred,
+  rest,
+  rolldown,
+  rollup,
+  select,
+  shunt,
+  stack_,
+  succ,
+  swaack,
+  swap,
+  take,
+  truthy,
+  tuck,
+  uncons,
+  unstack,
+  x,
+  )
+from .parser import Symbol
+from .utils.stack import iter_stack, list_to_stack, pushback
+
+
+class Untranslatable(Exception):
+  '''Raised when a definition can't be turned into straight-line code.'''
+
+
+# How deeply definitions may be inlined inside each other.
+MAX_DEPTH = 32
+
+# The functions of the SimpleFunctionWrappers that can be run on Values.
+PRIMITIVES = frozenset((
+  choice, clear, concat, cons, drop, dup, dupd, first, id_, over, pm,
+  pop, popd, popdd, popop, pred, rest, rolldown, rollup, select, shunt,
+  stack_, succ, swaack, swap, take, truthy, tuck, uncons, unstack,
+  ))
+
+
+class Translation(object):
+  '''The state of one translation: the emitted lines and the counter.'''
+
+  def __init__(self):
+    self.lines = []
+    self.count = 0
+
+  def new(self, template=None, *args):
+    '''
+    Return a fresh Value, assigning it the result of the template
+    filled in with the code of the args if given.
+    '''
+    self.count += 1
+    value = Value(self, 'v%i' % self.count)
+    if template is not None:
+      value.definition = template, args
+      self.lines.append('%s = %s' % (
+        value, template % tuple(map(code_of, args))))
+    return value
+
+
+class Value(object):
+  '''
+  A value only known at runtime, by the name of the variable holding it.
+  '''
+
+  __hash__ = object.__hash__
+
+  def __init__(self, translation, name):
+    self.translation = translation
+    self.name = name
+    self.parts = None
+    self.depth = None  # How far down the input stack this tail is.
+    self.origin = None  # (value, index) if destructured from a value.
+    self.definition = None  # (template, args) if computed.
+
+  def __str__(self):
+    return self.name
+
+  __repr__ = __str__
+
+  def _unpack(self):
+    if self.parts is None:
+      t = self.translation
+      self.parts = head, tail = t.new(), t.new()
+      t.lines.append('(%s, %s) = %s' % (head, tail, self))
+      head.origin, tail.origin = (self, 0), (self, 1)
+      if self.depth is not None:
+        tail.depth = self.depth + 1
+    return self.parts
+
+  def __iter__(self):
+    return iter(self._unpack())
+
+  def __getitem__(self, index):
+    return self._unpack()[index]
+
+  def __len__(self):
+    raise Untranslatable('The length of %s is only known at runtime.' % self)
+
+  def __nonzero__(self):
+    raise Untranslatable('The truth of %s is only known at runtime.' % self)
+
+  def _op(self, template, *args):
+    return self.translation.new(template, *args)
+
+
+def _binary_operator(symbol, reflected=False):
+  template = '(%%s %s %%s)' % (symbol.replace('%', '%%'),)
+  if reflected:
+    return lambda self, other: self._op(template, other, self)
+  return lambda self, other: self._op(template, self, other)
+
+
+for _name, _symbol in (
+  ('add', '+'), ('sub', '-'), ('mul', '*'), ('div', '/'),
+  ('truediv', '/'), ('floordiv', '//'), ('mod', '%'), ('pow', '**'),
+  ('lshift', '<<'), ('rshift', '>>'), ('and', '&'), ('or', '|'),
+  ('xor', '^'),
+  ):
+  setattr(Value, '__%s__' % _name, _binary_operator(_symbol))
+  setattr(Value, '__r%s__' % _name, _binary_operator(_symbol, True))
+
+for _name, _symbol in (
+  ('lt', '<'), ('le', '<='), ('eq', '=='),
+  ('ne', '!='), ('gt', '>'), ('ge', '>='),
+  ):
+  setattr(Value, '__%s__' % _name, _binary_operator(_symbol))
+
+Value.__neg__ = lambda self: self._op('(-%s)', self)
+Value.__abs__ = lambda self: self._op('abs(%s)', self)
+
+del _name, _symbol
+
+
+def code_of(thing):
+  '''Return Python source for a Value or a literal.'''
+  if isinstance(thing, Value):
+    return thing.name
+  if isinstance(thing, Symbol):
+    return 'Symbol(%r)' % (str(thing),)
+  if isinstance(thing, tuple):
+    if not thing:
+      return '()'
+    head, tail = thing
+    return '(%s, %s)' % (code_of(head), code_of(tail))
+  if isinstance(thing, (float, complex)) and not _finite(thing):
+    raise Untranslatable('No literal for %r' % (thing,))
+  if isinstance(thing, (bool, int, long, float, complex, str, unicode)):
+    return repr(thing)
+  raise Untranslatable('No literal for %r' % (thing,))
+
+
+def load(source, modules, filename='<translated>'):
+  '''
+  Run the Python source, which may use Symbol and the modules named in
+  the set modules, and return the namespace it defined its names in.
+  '''
+  namespace = {'Symbol': Symbol}
+  for name in modules:
+    __import__(name)
+    top = name.partition('.')[0]
+    namespace[top] = sys.modules[top]
+  exec compile(source, filename, 'exec') in namespace
+  return namespace
+
+
+def _finite(n):
+  return all(
+    part == part and abs(part) != float('inf')
+    for part in (n.real, n.imag)
+    )
+
+
+def _function_reference(f, modules):
+  '''Return Python source naming the function f, noting its module.'''
+  module = getattr(f, '__module__', None)
+  name = getattr(f, '__name__', None)
+  if not (module and name):
+    raise Untranslatable('Cannot refer to %r' % (f,))
+  if module == '__builtin__':
+    return name
+  modules.add(module)
+  return '%s.%s' % (module, name)
+
+
+class Translator(object):
+  '''
+  Runs expressions on stacks of Values and literals, emitting the code
+  into the translation.  Only the SimpleFunctionWrappers whose functions
+  are in primitives are run.
+  '''
+
+  def __init__(self, dictionary, translation, modules, primitives=PRIMITIVES):
+    self.dictionary = dictionary
+    self.translation = translation
+    self.modules = modules
+    self.primitives = primitives  # The functions of SimpleFunctionWrappers.
+    self.steps = 0  # Terms evaluated, as joy() would count them.
+
+  def run(self, stack, expression, depth=0):
+    '''
+    Return the stack after the expression.  Raise Untranslatable if it
+    can't be translated.
+    '''
+    if depth > MAX_DEPTH:
+      raise Untranslatable('Definitions nested too deeply.')
+    while expression:
+      self.steps += 1
+      term, expression = expression
+      if not isinstance(term, Symbol):
+        stack = term, stack
+        continue
+      try:
+        F = self.dictionary[term]
+      except KeyError:
+        raise Untranslatable('Unknown word %s' % (term,))
+      stack, expression = self.apply(F, stack, expression, depth)
+    return stack
+
+  def apply(self, F, stack, expression, depth):
+    '''
+    Return (stack, expression) after the word F, which may push quotes
+    onto the expression.  Raise Untranslatable if it can't be translated.
+    '''
+    kind = F.__class__
+
+    if kind is SimpleFunctionWrapper:
+      if F.f not in self.primitives:
+        raise Untranslatable('%s looks at the types of items.' % (F.name,))
+      return F.f(stack), expression
+
+    if kind is BinaryBuiltinWrapper:
+      (a, (b, stack)) = stack
+      return (self.call(F.f, b, a), stack), expression
+
+    if kind is UnaryBuiltinWrapper:
+      (a, stack) = stack
+      return (self.call(F.f, a), stack), expression
+
+    if isinstance(F, DefinitionWrapper):
+      return self.run(stack, F.body, depth + 1), expression
+
+    if kind is FunctionWrapper and F.f in INLINE:
+      return INLINE[F.f](self, stack, expression, depth)
+
+    raise Untranslatable('Cannot translate %s' % (F.name,))
+
+  def call(self, f, *args):
+    if not any(isinstance(arg, Value) for arg in args):
+      return f(*args)  # Fold constants now.
+    return self.translation.new('%s(%s)' % (
+      _function_reference(f, self.modules),
+      ', '.join(['%s'] * len(args)),
+      ), *args)
+
+
+def _literal_quote(quote):
+  if isinstance(quote, Value):
+    raise Untranslatable('Quote %s is only known at runtime.' % quote)
+  return quote
+
+
+def _i(translator, stack, expression, depth):
+  quote, stack = stack
+  return stack, pushback(_literal_quote(quote), expression)
+
+
+def _x(translator, stack, expression, depth):
+  quote, _ = stack
+  return stack, pushback(_literal_quote(quote), expression)
+
+
+def _b(translator, stack, expression, depth):
+  q, (p, stack) = stack
+  expression = pushback(_literal_quote(q), expression)
+  return stack, pushback(_literal_quote(p), expression)
+
+
+def _dip_n(n):
+  def dip(translator, stack, expression, depth):
+    quote, stack = stack
+    items = []
+    for _ in range(n):
+      item, stack = stack
+      items.append(item)
+    expression = list_to_stack(items[::-1], expression)
+    return stack, pushback(_literal_quote(quote), expression)
+  return dip
+
+
+def _dupdip(translator, stack, expression, depth):
+  quote, stack = stack
+  expression = stack[0], expression
+  return stack, pushback(_literal_quote(quote), expression)
+
+
+def _infra(translator, stack, expression, depth):
+  quote, (aggregate, stack) = stack
+  result = translator.run(aggregate, _literal_quote(quote), depth + 1)
+  return (result, stack), expression
+
+
+INLINE = {
+  b: _b,
+  dip: _dip_n(1),
+  dipd: _dip_n(2),
+  dipdd: _dip_n(3),
+  dupdip: _dupdip,
+  i: _i,
+  infra: _infra,
+  x: _x,
+  }
+
+
+def _translate(F, dictionary, modules):
+  translation = Translation()
+  stack = Value(translation, 'stack')
+  stack.depth = 0
+  result = Translator(dictionary, translation, modules).run(stack, F.body)
+  return translation.lines, result
+
+
+def _effect(result):
+  outputs = 0
+  while isinstance(result, tuple) and result:
+    outputs += 1
+    _, result = result
+  if isinstance(result, Value) and result.depth is not None:
+    return result.depth, outputs
+  return None
+
+
+def infer_stack_effect(F, dictionary):
+  '''
+  Return the stack effect of the definition F as a pair (number of items
+  taken, number of items left in their place), or None if it doesn't
+  have one.  Raise Untranslatable if F can't be translated.
+  '''
+  return _effect(_translate(F, dictionary, set())[1])
+
+
+def translate(F, dictionary):
+  '''
+  Return (source, modules) where source is the Python source of a
+  function equivalent to the definition F and modules is the set of the
+  names of the modules it needs imported.  Raise Untranslatable if F
+  can't be translated.
+  '''
+  modules = set()
+  lines, result = _translate(F, dictionary, modules)
+  effect = _effect(result)
+  doc = '%s == %s' % (F.name, F.__doc__)
+  if effect:
+    doc += '\n\n  Stack effect: (%i -- %i)' % effect
+  source = ['def %s(stack):' % (_identifier(F.name),), "  '''%s\n  '''" % (
+    doc.replace('\\', '\\\\').replace("'''", "\\'\\'\\'"),)]
+  source.extend('  ' + line for line in lines)
+  source.append('  return %s' % (code_of(result),))
+  return '\n'.join(source), modules
+
+
+def _identifier(name):
+  ident = re.sub(
+    r'[^0-9a-zA-Z_]',
+    lambda match: '_%02x' % ord(match.group()),
+    name,
+    )
+  return 'joy_' + ident
+
+
+_HEADER = """\
+# -*- coding: utf-8 -*-
+'''
+Definitions translated to Python by joy.translator.
+
+To use them, put them in a dictionary:
+
+  dictionary.update((F.name, F) for F in definitions)
+
+'''
+"""
+
+
+def generate_module(dictionary, names=None):
+  '''
+  Return the source of a Python module with translations of all the
+  definitions (or those named) in the dictionary that can be translated.
+  It has a tuple named "definitions" of SimpleFunctionWrappers.
+  '''
+  if names is None:
+    names = sorted(dictionary)
+  modules = set()
+  functions = []
+  for name in names:
+    F = dictionary[name]
+    if not isinstance(F, DefinitionWrapper):
+      continue
+    try:
+      source, needed = translate(F, dictionary)
+    except (Untranslatable, TypeError, ValueError, ArithmeticError):
+      continue
+    modules.update(needed)
+    functions.append((name, source))
+
+  out = [_HEADER]
+  out.extend('import %s' % (module,) for module in sorted(modules))
+  out.append('from joy.library import SimpleFunctionWrapper')
+  out.append('from joy.parser import Symbol')
+  out.append('\n\ndef _wrap(f, name):')
+  out.append('  F = SimpleFunctionWrapper(f)')
+  out.append('  F.name = F.__name__ = name')
+  out.append('  return F\n\n')
+  for _, source in functions:
+    out.append(source + '\n\n')
+  out.append('definitions = (')
+  out.extend(
+    '  _wrap(%s, %r),' % (_identifier(name), name)
+    for name, _ in functions
+    )
+  out.append('  )\n')
+  return '\n'.join(out)
+
+
+def write_module(filename, dictionary, names=None):
+  '''Write the output of generate_module() to a file.'''
+  with open(filename, 'w') as f:
+    f.write(generate_module(dictionary, names))
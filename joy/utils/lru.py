@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ LRU Cache
+
+
+A mapping that forgets the least recently used entries once it has more
+than max_items of them or they use more than max_bytes (estimated with
+sys.getsizeof(), following tuples, so a cons list is counted cell by
+cell and anything shared is counted once.)  It keeps hit, miss and
+eviction counts.  A lock is held while the entries are touched, so one
+cache can be shared between threads.
+
+Exports:
+
+  LRUCache(max_items=None, max_bytes=None)
+
+  sizeof(thing)
+
+'''
+from collections import OrderedDict
+from sys import getsizeof
+from threading import Lock
+
+
+class LRUCache(object):
+  '''
+  A mapping that forgets the least recently used entries once it has
+  more than max_items of them or they use more than max_bytes.
+  '''
+
+  def __init__(self, max_items=None, max_bytes=None):
+    self.max_items = max_items
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.hits = self.misses = self.evictions = 0
+    self._entries = OrderedDict()  # key -> (value, size)
+    self._lock = Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        entry = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries[key] = entry  # Now the most recently used.
+      self.hits += 1
+    return entry[0]
+
+  def put(self, key, value, size=None):
+    '''
+    Store value under key.  Pass its size if you know it, otherwise it
+    is estimated (if there's a max_bytes.)
+    '''
+    if size is None:
+      size = sizeof((key, value)) if self.max_bytes is not None else 0
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old:
+        self.bytes -= old[1]
+      self._entries[key] = value, size
+      self.bytes += size
+      while self._entries and (
+        (self.max_items is not None and len(self._entries) > self.max_items)
+        or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+        _, (_, size) = self._entries.popitem(last=False)
+        self.bytes -= size
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.bytes = 0
+
+  def stats(self):
+    '''Return a dict of the counts.'''
+    lookups = self.hits + self.misses
+    return {
+      'entries': len(self._entries),
+      'bytes': self.bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+
+def sizeof(thing):
+  '''Estimate the memory used by thing, counting shared parts once.'''
+  seen = set()
+  total = 0
+  to_do = [thing]
+  while to_do:
+    thing = to_do.pop()
+    if id(thing) in seen:
+      continue
+    seen.add(id(thing))
+    total += getsizeof(thing)
+    if isinstance(thing, tuple):
+      to_do.extend(thing)
+  return total
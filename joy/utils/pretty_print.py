@@ -33,11 +33,17 @@ This is what does the formatting, e.g.:
 # (Kinda clunky and hacky.  This should be swapped out in favor of much
 # smarter stuff.)
 from __future__ import print_function
+from collections import deque
+from sys import stdout
 from traceback import print_exc
-from .stack import expression_to_string, stack_to_string
+from .stack import expression_to_string, list_to_stack, stack_to_string
+from .vector import cell_id
 
 
 class TracePrinter(object):
+  '''
+  Keep every (stack, expression) pair and print them all at the end.
+  '''
 
   def __init__(self):
     self.history = []
@@ -49,11 +55,16 @@ class TracePrinter(object):
   def __str__(self):
     return '\n'.join(self.go())
 
+  def states(self):
+    '''Iterate through the (stack, expression) pairs kept.'''
+    return iter(self.history)
+
   def go(self):
     max_stack_length = 0
     lines = []
-    for stack, expression in self.history:
-      stack = stack_to_string(stack)
+    tails = {}
+    for stack, expression in self.states():
+      stack = stack_to_string(stack, tails=tails)
       expression = expression_to_string(expression)
       n = len(stack)
       if n > max_stack_length:
@@ -70,3 +81,144 @@ class TracePrinter(object):
     except:
       print_exc()
       print('Exception while printing viewer.')
+
+
+class StreamingTracePrinter(object):
+  '''
+  Write each line to the sink (any file-like object) as it happens and
+  keep nothing.  As the lines can't be lined up after the fact the '.'s
+  line up with the widest stack seen so far (or width, if wider.)
+  '''
+
+  def __init__(self, sink=stdout, width=0):
+    self.sink = sink
+    self.width = width
+    self.steps = 0
+    self._tails = {}
+
+  def viewer(self, stack, expression):
+    '''Pass this method as the viewer to joy() function.'''
+    stack = stack_to_string(stack, tails=self._tails)
+    self.width = max(self.width, len(stack))
+    self.sink.write('%*s . %s\n' % (
+      self.width, stack, expression_to_string(expression)))
+    self.steps += 1
+
+  def print_(self):
+    self.sink.flush()
+
+
+class RingTracePrinter(TracePrinter):
+  '''
+  Keep only the last size steps, e.g. to see what led up to an error.
+  '''
+
+  def __init__(self, size=100):
+    self.history = deque(maxlen=size)
+    self.steps = 0
+
+  def viewer(self, stack, expression):
+    '''Pass this method as the viewer to joy() function.'''
+    self.history.append((stack, expression))
+    self.steps += 1
+
+  def go(self):
+    lines = TracePrinter.go(self)
+    dropped = self.steps - len(self.history)
+    if dropped:
+      lines.insert(0, '... (%i earlier steps)' % (dropped,))
+    return lines
+
+
+class DeltaTracePrinter(TracePrinter):
+  '''
+  Keep the history, but as the changes from each step to the next
+  rather than the stacks and expressions themselves.  Those share
+  structure with each other, so the changes are small: a few items
+  popped from the top and a few pushed.  Keeping only the changes lets
+  the old stacks and expressions be garbage collected.
+
+  The changes still grow with the number of steps, so as with
+  RingTracePrinter if size is given only the last size steps are kept.
+  '''
+
+  def __init__(self, size=None):
+    self.size = size
+    self.first = None
+    self.deltas = [] if size is None else deque()
+    self.steps = 0
+    self._last = None
+
+  def viewer(self, stack, expression):
+    '''Pass this method as the viewer to joy() function.'''
+    self.steps += 1
+    if self._last is None:
+      self.first = stack, expression
+    else:
+      last_stack, last_expression = self._last
+      self.deltas.append(
+        _delta(last_stack, stack) + _delta(last_expression, expression))
+      if self.size is not None and len(self.deltas) >= self.size:
+        self.first = _forward(self.first, self.deltas.popleft())
+    self._last = stack, expression
+
+  def states(self):
+    if self.first is None:
+      return
+    state = self.first
+    yield state
+    for delta in self.deltas:
+      state = _forward(state, delta)
+      yield state
+
+  def go(self):
+    lines = TracePrinter.go(self)
+    dropped = self.steps - len(lines)
+    if dropped:
+      lines.insert(0, '... (%i earlier steps)' % (dropped,))
+    return lines
+
+
+def _forward((stack, expression), delta):
+  '''Return the state after the delta (from _delta()) is made.'''
+  popped, pushed, expression_popped, expression_pushed = delta
+  return (
+    _apply(stack, popped, pushed),
+    _apply(expression, expression_popped, expression_pushed),
+    )
+
+
+def _delta(old, new):
+  '''
+  Return (popped, pushed) such that new is old with popped items taken
+  off the top and the items in the tuple pushed put on.
+  '''
+  # Walk down both at once until one reaches a cell the other has seen.
+  old_seen = {}  # cell_id of a cell of old -> how far down old it is.
+  new_seen = {}  # cell_id of a cell of new -> how many items are above it.
+  depth = 0
+  pushed = []
+  while True:
+    if old is not None:
+      key = cell_id(old)
+      if key in new_seen:
+        return depth, tuple(pushed[:new_seen[key]])
+      old_seen[key] = depth
+      old = old[1] if old else None
+      depth += 1
+    if new is not None:
+      key = cell_id(new)
+      if key in old_seen:
+        return old_seen[key], tuple(pushed)
+      new_seen[key] = len(pushed)
+      if new:
+        item, new = new
+        pushed.append(item)
+      else:
+        new = None
+
+
+def _apply(stack, popped, pushed):
+  for _ in range(popped):
+    stack = stack[1]
+  return list_to_stack(pushed, stack)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Binary Serialization
+
+
+stack_to_string() and text_to_expression() make a round trip through
+text, but that's slow for big data, a string and a Symbol come back the
+same if they print the same, and a stack that shares its tail with
+another is printed (and parsed) out in full each time.  This module
+writes stacks and expressions (or anything else made of cons cells,
+Vectors, ints, longs, bools, floats, complex numbers, strings, unicode
+strings and Symbols) in a compact binary format and reads them back.
+Instances of subclasses of Symbol are written as names and read back as
+plain Symbols.
+
+  data = dumps(stack)
+  stack = loads(data)
+
+  dump(stack, f)
+  stack = load(f)
+
+The format is a little program for a stack machine, run by the reader.
+The machine has a "top" and a stack under it, and these opcodes:
+
+  n  push top, top = ()
+  r  push top, top = the cell numbered by the next atom
+  c  top = (next atom, top)
+  y  top = (Symbol(next atom), top)
+  q  top = (top, pop)
+  a  push top, top = next atom
+  z  push top, top = Symbol(next atom)
+  v  push top, top = a Vector (the next atoms are its typecode and numbers)
+
+and the bytes from 128 to 255, which stand for the first 128 different
+Symbols in each block: top = (that Symbol, top).  So most words in an
+expression take one byte.
+
+Every cell made (by all but n, r, a and z) gets the next number, so a list is
+written from its end and a quote in it is made on top of the list and
+then consed onto it:
+
+  [1 [2] a]  ->  n y"a" n c2 q c1
+
+If the same cell (the same object, not just an equal one) comes up again
+it's written as an r, so shared structure is written once and read back
+shared.  Neither writing nor reading recurses, so there's no limit on
+the nesting.
+
+The opcodes and the atoms they use are written in blocks of BLOCK
+opcodes or so, each a marshalled (opcodes, atoms, symbols) triple after
+its length in four bytes, so the atoms are packed and unpacked by
+marshal's C code and only one block at a time need be held as bytes.
+
+A value starts with a two byte header (the format version is the second
+byte) and ends with an empty block, so values can be written one after
+another to a file, a pipe or a socket; load() reads exactly one of them
+and iter_load() reads them until the end.  (The garbage collector is
+paused while they work, except on data loads() can see is small, as it
+is by the parser and for the same reason.)
+
+A TypeError is raised for things that can't be written and a ValueError
+for data that can't be read.  Like marshal (and pickle) this is not
+meant for data from untrusted sources.
+
+Exports:
+
+  dumps(thing)
+
+  loads(data)
+
+  dump(thing, f)
+
+  load(f)
+
+  iter_load(f)
+
+'''
+from marshal import dumps as _marshal, loads as _unmarshal
+from array import array
+from struct import Struct
+from ..parser import Symbol, _gc_paused
+from .vector import Vector
+
+
+VERSION = 1
+HEADER = 'J' + chr(VERSION)
+BLOCK = 8192
+
+_length = Struct('<I')
+
+# Opcodes for the symbols in a block.
+_SYMBOL_OPS = map(chr, range(128, 256))
+
+# The types marshal writes and reads back as they are.
+_ATOMS = frozenset((int, long, bool, float, complex, str, unicode))
+
+
+#
+# § Writing
+#
+
+
+def dumps(thing):
+  '''Return the binary form of thing as a string.'''
+  parts = []
+  with _gc_paused():
+    _write(thing, parts.append)
+  return ''.join(parts)
+
+
+def dump(thing, f):
+  '''Write the binary form of thing to the file object f.'''
+  with _gc_paused():
+    _write(thing, f.write)
+
+
+def _write(thing, write):
+  write(HEADER)
+  ops, atoms, symbols = [], [], {}
+  op, atom = ops.append, atoms.append
+  cells = {}  # id of cell -> its number.
+
+  if not isinstance(thing, tuple):
+    if isinstance(thing, Symbol):
+      op('z')
+      atom(str(thing))
+    elif type(thing) in _ATOMS:
+      op('a')
+      atom(thing)
+    else:
+      raise TypeError('Cannot serialize %r' % (thing,))
+    _block(write, ops, atoms, symbols)
+    write(_length.pack(0))
+    return
+
+  pending = []  # (chain, index) of lists whose heads are being written.
+  count, flush = 0, BLOCK
+  chain = _chain(thing, cells, op, atom)
+  index = len(chain)
+  while True:
+
+    while index:
+      index -= 1
+      cell = chain[index]
+      head = cell[0]
+      kind = type(head)
+      if kind is not Symbol and isinstance(head, Symbol):
+        kind = Symbol  # It's read back as a plain Symbol.
+
+      if kind is Symbol:
+        code = symbols.get(head)
+        if code is None and len(symbols) < len(_SYMBOL_OPS):
+          code = symbols[head] = _SYMBOL_OPS[len(symbols)]
+        if code is None:
+          op('y')
+          atom(str(head))
+        else:
+          op(code)
+
+      elif kind in _ATOMS:
+        op('c')
+        atom(head)
+
+      elif kind is tuple or kind is Vector:
+        number = cells.get(id(head)) if head else None
+        if number is None and head:
+          pending.append((chain, index))  # Write the quote first.
+          chain = _chain(head, cells, op, atom)
+          index = len(chain)
+          continue
+        if number is None:
+          op('n')
+        else:
+          op('r')
+          atom(number)
+        op('q')
+
+      else:
+        raise TypeError('Cannot serialize %r' % (head,))
+
+      cells[id(cell)] = count
+      count += 1
+      if count >= flush:
+        _block(write, ops, atoms, symbols)
+        flush = count + BLOCK
+
+    if not pending:
+      break
+    chain, index = pending.pop()
+    op('q')
+    cells[id(chain[index])] = count
+    count += 1
+
+  _block(write, ops, atoms, symbols)
+  write(_length.pack(0))
+
+
+def _chain(stack, cells, op, atom):
+  '''
+  Write the opcode for the end of the list stack ((), a Vector or a cell
+  that's already been written) and return the list of cells before it.
+  '''
+  chain = []
+  append = chain.append
+  try:
+    while stack:
+      if type(stack) is Vector or id(stack) in cells:
+        break
+      append(stack)
+      _, stack = stack
+  except (TypeError, ValueError):
+    raise TypeError('Not a cons cell: %r' % (stack,))
+  if type(stack) is Vector:
+    op('v')
+    atom(stack.data.typecode)
+    atom(stack.tolist())
+  elif type(stack) is not tuple:
+    raise TypeError('Not a stack: %r' % (stack,))
+  elif stack:
+    op('r')
+    atom(cells[id(stack)])
+  else:
+    op('n')
+  return chain
+
+
+def _block(write, ops, atoms, symbols):
+  if ops:
+    names = [None] * len(symbols)
+    for name, code in symbols.iteritems():
+      names[ord(code) - 128] = str(name)
+    data = _marshal((''.join(ops), atoms, names), 2)
+    write(_length.pack(len(data)) + data)
+    del ops[:], atoms[:]
+    symbols.clear()
+
+
+#
+# § Reading
+#
+
+
+def loads(data):
+  '''Return the thing in the binary form data.'''
+  pos = [0]
+  def read(n):
+    start = pos[0]
+    pos[0] += n
+    return data[start:start + n]
+  with _gc_paused(len(data)):
+    thing = _read(read)
+  if pos[0] < len(data):
+    raise ValueError('Extra data after the value.')
+  return thing
+
+
+def load(f):
+  '''Read and return the next thing in the file object f.'''
+  with _gc_paused():
+    return _read(f.read)
+
+
+def iter_load(f):
+  '''Yield each thing in the file object f until it ends.'''
+  while True:
+    try:
+      with _gc_paused():
+        thing = _read(f.read)
+    except EOFError:
+      break
+    yield thing
+
+
+def _read(read):
+  '''
+  Read a value with the function read(n) (which returns n bytes, or
+  fewer at the end) and return it.  Raise EOFError if there's nothing
+  left at all to read.
+  '''
+  header = read(len(HEADER))
+  if not header:
+    raise EOFError
+  if header != HEADER:
+    if header[:1] == 'J':
+      raise ValueError('Unknown format version.')
+    raise ValueError('Not a serialized value.')
+  top, stack, cells = None, [], []
+  push, pop, cell = stack.append, stack.pop, cells.append
+  try:
+    while True:
+      n = read(_length.size)
+      if len(n) < _length.size:
+        raise ValueError('Truncated data.')
+      n, = _length.unpack(n)
+      if not n:
+        break
+      data = read(n)
+      if len(data) < n:
+        raise ValueError('Truncated data.')
+      ops, atoms, names = _unmarshal(data)
+      if type(ops) is not str or type(atoms) is not list:
+        raise ValueError('Corrupt data.')
+      atom = iter(atoms).next
+      symbol = dict(zip(_SYMBOL_OPS, map(Symbol, names))).get
+
+      for op in ops:
+        head = symbol(op)
+        if head is not None:
+          top = head, top
+          cell(top)
+        elif op == 'c':
+          top = atom(), top
+          cell(top)
+        elif op == 'y':
+          top = Symbol(atom()), top
+          cell(top)
+        elif op == 'q':
+          top = top, pop()
+          cell(top)
+        elif op == 'n':
+          push(top)
+          top = ()
+        elif op == 'r':
+          push(top)
+          top = cells[atom()]
+        elif op == 'a':
+          push(top)
+          top = atom()
+        elif op == 'z':
+          push(top)
+          top = Symbol(atom())
+        elif op == 'v':
+          push(top)
+          typecode = atom()
+          top = Vector(array(typecode, atom()))
+          if not top.data:
+            raise ValueError('Corrupt data.')
+        else:
+          raise ValueError('Unknown opcode %r.' % (op,))
+
+  except (EOFError, IndexError, StopIteration, TypeError):
+    raise ValueError('Corrupt data.')
+  if stack != [None]:
+    raise ValueError('Corrupt data.')
+  return top
@@ -72,6 +72,7 @@ incoming argument and assigning values to the names.  Note that Python
 syntax doesn't require parentheses around tuples used in expressions
 where they would be redundant.
 '''
+from .vector import Vector
 
 
 def list_to_stack(el, stack=()):
@@ -87,46 +88,171 @@ def list_to_stack(el, stack=()):
 
 def iter_stack(stack):
   '''Iterate through the items on the stack.'''
+  if isinstance(stack, Vector):
+    for item in stack.items():
+      yield item
+    return
   while stack:
     item, stack = stack
     yield item
 
 
-def stack_to_string(stack):
+def stack_to_string(stack, max_depth=None, max_items=None, tails=None):
   '''
   Return a "pretty print" string for a stack.
 
   The items are written right-to-left:
 
   (top, (second, ...)) -> '... second top'
+
+  Quotes nested more than max_depth deep are shown as [...] and only
+  the top max_items items of the stack (and the first max_items of any
+  quote) are shown, with ... in place of the rest.
+
+  Without limits, if tails is a dict the strings of the bottom of the
+  stack are kept in it (see _Chunk) and used the next time it's passed,
+  so that printing one stack after another that shares its bottom (as
+  a viewer does) only has to do the items near the top.  The dict only
+  keeps the last stack printed.
   '''
-  f = lambda stack: reversed(list(iter_stack(stack)))
-  return _to_string(stack, f)
+  if not isinstance(stack, tuple) or not stack:
+    return _to_string(stack)
+  if max_depth is None and max_items is None and tails is not None:
+    return _cached_stack_to_string(stack, tails)
+  items = []
+  for item in iter_stack(stack):
+    if max_items is not None and len(items) >= max_items:
+      items.append(ELISION)
+      break
+    items.append(_s(item, max_depth, max_items))
+  items.reverse()
+  return ' '.join(items)
 
 
-def expression_to_string(expression):
+def expression_to_string(expression, max_depth=None, max_items=None):
   '''
   Return a "pretty print" string for a expression.
 
   The items are written left-to-right:
 
   (top, (second, ...)) -> 'top second ...'
+
+  The limits are as for stack_to_string().
   '''
-  return _to_string(expression, iter_stack)
+  if not isinstance(expression, tuple):
+    return _to_string(expression)
+  return _render(expression, max_depth, max_items)
+
+
+ELISION = '...'
+
 
+def _to_string(thing):
+  if isinstance(thing, long): return str(thing).rstrip('L')
+  if not isinstance(thing, tuple): return repr(thing)
+  return ''
 
-def _to_string(stack, f):
-  if isinstance(stack, long): return str(stack).rstrip('L')
-  if not isinstance(stack, tuple): return repr(stack)
-  if not stack: return ''  # shortcut
-  return ' '.join(map(_s, f(stack)))
 
+def _s(thing, max_depth=None, max_items=None):
+  '''Return the string for an item on a stack or in an expression.'''
+  if isinstance(thing, tuple):
+    if max_depth is not None and max_depth < 1 and thing:
+      return '[%s]' % (ELISION,)
+    if max_depth is not None:
+      max_depth -= 1
+    return '[%s]' % _render(thing, max_depth, max_items)
+  return _to_string(thing)
 
-_s = lambda s: (
-  '[%s]' % expression_to_string(s) if isinstance(s, tuple)
-  else str(s).rstrip('L') if isinstance(s, long)
-  else repr(s)
-  )
+
+_OPEN, _CLOSE = object(), object()
+
+
+def _render(expression, max_depth, max_items):
+  '''
+  Return the items of expression, left-to-right.  This doesn't recurse
+  so there's no limit on how deeply quotes can be nested.
+  '''
+  tokens = []
+  frames = [[expression, 0]]  # The rest of each open list, items shown.
+  while frames:
+    frame = frames[-1]
+    rest, count = frame
+    if not rest or (max_items is not None and count >= max_items):
+      if rest:
+        tokens.append(ELISION)
+      frames.pop()
+      if frames:
+        tokens.append(_CLOSE)
+      continue
+    item, frame[0] = rest
+    frame[1] += 1
+    if not isinstance(item, tuple):
+      tokens.append(_to_string(item))
+    elif not item:
+      tokens.append('[]')
+    elif max_depth is not None and len(frames) > max_depth:
+      tokens.append('[%s]' % (ELISION,))
+    else:
+      tokens.append(_OPEN)
+      frames.append([item, 0])
+  parts = []
+  previous = _OPEN
+  for token in tokens:
+    if previous is not _OPEN and token is not _CLOSE:
+      parts.append(' ')
+    parts.append(
+      '[' if token is _OPEN else ']' if token is _CLOSE else token)
+    previous = token
+  return ''.join(parts)
+
+
+# The strings of the bottom parts of stacks, as a chain of _Chunks.
+# Every CHUNK items from the bottom of a stack the id of the cons cell
+# there is a key in the tails dict to the _Chunk of the string of the
+# items from it down to the next such cell.  Stacks share their bottoms
+# so printing a stack after a change only has to do the items above the
+# first cell found in there.
+CHUNK = 32
+
+
+class _Chunk(object):
+
+  __slots__ = ['cell', 'text', 'length', 'below']
+
+  def __init__(self, cell, text, length, below):
+    self.cell = cell
+    self.text = text
+    self.length = length
+    self.below = below
+
+
+def _cached_stack_to_string(stack, tails):
+  cells = []
+  chunk = None
+  while stack:
+    found = tails.get(id(stack))
+    if found is not None and found.cell is stack:
+      chunk = found
+      break
+    cells.append(stack)
+    stack = stack[1]
+  length = chunk.length if chunk else 0
+  pending = []
+  for cell in reversed(cells):
+    pending.append(_s(cell[0]))
+    length += 1
+    if not length % CHUNK:
+      chunk = _Chunk(cell, ' '.join(pending), length, chunk)
+      pending = []
+  tails.clear()  # Keep this stack's chunks, and only them.
+  texts = []
+  while chunk:
+    tails[id(chunk.cell)] = chunk
+    texts.append(chunk.text)
+    chunk = chunk.below
+  texts.reverse()
+  texts.extend(pending)
+  return ' '.join(texts)
 
 
 def pushback(quote, expression):
@@ -143,6 +269,8 @@ def pick(s, n):
   '''
   if n < 0:
     raise ValueError
+  if isinstance(s, Vector):
+    return s.item(n)
   while True:
     try:
       item, s = s
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Vectors
+
+
+A list of thousands of numbers is thousands of cons cells, and summing
+or sorting it means walking them all in Python.  A Vector is a list of
+numbers packed into an array.array, all ints ('l') or all floats ('d'),
+that is also a cons cell: it's a tuple and unpacks as one,
+
+  head, tail = vector
+
+giving its first number and a Vector of the rest (which shares the
+array) or () after the last number.  So every word that works on lists
+works on Vectors without them being converted, and a list made by
+consing onto a Vector just has a Vector for its tail.  Only the cells
+that get unpacked are ever made, and each only once: a Vector keeps its
+tail, so unpacking it again gives the very same object, as it would for
+a tuple.  Vectors are equal to the lists of the same numbers, hash the
+same, and print the same.
+
+Code that tells cells apart by identity (to find shared structure, say)
+should use cell_id(), which is the same for every Vector of the same
+array from the same index on.
+
+The words that can use the array directly do (first, rest, size,
+getitem, sum, max, min, sort and so on, see library.py), and arithmetic
+on a Vector and a number, or two Vectors of the same length, works on
+each number in turn and gives a Vector:
+
+  [1 2 3] vector 10 *  ->  [10 20 30]
+
+pack() (the vector word) only packs lists of numbers that will come
+back out of the array as they went in, so a Vector is never different
+from the list it was made from.  Otherwise it leaves the list alone.
+The same goes for the results of arithmetic, which are plain lists if
+they won't pack (e.g. ints too big for a C long.)
+
+(The arrays are array.arrays rather than NumPy arrays because NumPy's
+ints wrap around on overflow and its floats don't raise on division by
+zero, and Joy's numbers are Python's.)
+
+Exports:
+
+  Vector(data, start=0)
+
+  cell_id(cell)
+
+  pack(items)
+
+'''
+from array import array
+from itertools import imap, islice, repeat
+import operator
+
+
+class Vector(tuple):
+  '''
+  The numbers in the array data from index start on, which must be at
+  least one, as a Joy list.
+  '''
+
+  def __new__(class_, data, start=0):
+    vector = tuple.__new__(class_)
+    vector.data = data
+    vector.start = start
+    vector._rest = None
+    return vector
+
+  # As a cons cell.
+
+  def __len__(self):
+    return 2
+
+  def __nonzero__(self):
+    return True
+
+  def __iter__(self):
+    return iter((self.data[self.start], self.rest()))
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return tuple(self)[index]
+    if index in (0, -2):
+      return self.data[self.start]
+    if index in (1, -1):
+      return self.rest()
+    raise IndexError('tuple index out of range')
+
+  def rest(self):
+    rest = self._rest
+    if rest is None:
+      start = self.start + 1
+      rest = Vector(self.data, start) if start < len(self.data) else ()
+      self._rest = rest
+    return rest
+
+  def __repr__(self):
+    return 'Vector(%r)' % (self.tolist(),)
+
+  def __reduce__(self):
+    return Vector, (self.data[self.start:],)
+
+  # As a list.
+
+  def size(self):
+    return len(self.data) - self.start
+
+  def items(self):
+    '''Return an iterator over the numbers.'''
+    return islice(self.data, self.start, None)
+
+  def tolist(self):
+    return self.data[self.start:].tolist()
+
+  def item(self, n):
+    '''Return the nth number, or raise IndexError.'''
+    if n < 0:
+      raise ValueError
+    return self.data[self.start + n]
+
+  def sorted(self):
+    return Vector(array(self.data.typecode, sorted(self.items())))
+
+  def concat(self, other):
+    '''Return a Vector of these numbers then other's (of the same kind.)'''
+    return Vector(
+      self.data[self.start:] + other.data[other.start:])
+
+  def as_stack(self):
+    '''Return the numbers as a list made of plain tuples.'''
+    return _list_to_stack(self.tolist())
+
+  # Comparisons (and hashes) are as for lists.
+
+  def __hash__(self):
+    hashed = hash(())
+    for item in reversed(self.tolist()):
+      hashed = hash((item, _Hash(hashed)))
+    return hashed
+
+  def __eq__(self, other):
+    if isinstance(other, Vector):
+      return self.tolist() == other.tolist()
+    if not isinstance(other, tuple):
+      return NotImplemented
+    for item in self.items():
+      if not isinstance(other, tuple) or len(other) != 2:
+        return False
+      head, other = other
+      if head != item:
+        return False
+    return other == ()
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    return equal if equal is NotImplemented else not equal
+
+  def __lt__(self, other):
+    return self.as_stack() < _as_stack(other)
+
+  def __le__(self, other):
+    return self.as_stack() <= _as_stack(other)
+
+  def __gt__(self, other):
+    return self.as_stack() > _as_stack(other)
+
+  def __ge__(self, other):
+    return self.as_stack() >= _as_stack(other)
+
+
+class _Hash(object):
+  '''Stands for a tail, with its hash, in a cons cell being hashed.'''
+
+  __slots__ = 'value',
+
+  def __init__(self, value):
+    self.value = value
+
+  def __hash__(self):
+    return self.value
+
+
+def _as_stack(thing):
+  return thing.as_stack() if isinstance(thing, Vector) else thing
+
+
+def cell_id(cell):
+  '''
+  Return what tells the cons cell apart from others: its id, or for a
+  Vector the id of its array and its start.
+  '''
+  if type(cell) is Vector:
+    return id(cell.data), cell.start
+  return id(cell)
+
+
+# The typecode for lists of each kind of number.  Bools would come back
+# out as ints so they aren't packed.
+_TYPECODES = {
+  frozenset((int,)): 'l',
+  frozenset((int, long)): 'l',
+  frozenset((long,)): 'l',
+  frozenset((float,)): 'd',
+  }
+
+
+def pack(items):
+  '''
+  Return a Vector of the numbers in the sequence items, or None if they
+  aren't all ints or all floats (or there aren't any.)
+  '''
+  if not items:
+    return None
+  typecode = _TYPECODES.get(frozenset(imap(type, items)))
+  if typecode is None:
+    return None
+  try:
+    return Vector(array(typecode, items))
+  except OverflowError:  # A long too big for a C long.
+    return None
+
+
+def _arithmetic(op, reflected=False):
+  '''
+  Return a method that does op to each number and a number or to each
+  pair of numbers of two Vectors.
+  '''
+
+  def method(self, other):
+    if isinstance(other, Vector):
+      if other.size() != self.size():
+        raise ValueError('Vectors of different sizes.')
+      others = other.items()
+    elif isinstance(other, (int, long, float)):
+      others = repeat(other)
+    elif isinstance(other, tuple):  # Don't let tuple concatenate them.
+      raise TypeError('Arithmetic on a Vector and a list.')
+    else:
+      return NotImplemented
+    if reflected:
+      results = list(imap(op, others, self.items()))
+    else:
+      results = list(imap(op, self.items(), others))
+    vector = pack(results)
+    if vector is None:
+      return _list_to_stack(results)
+    return vector
+
+  return method
+
+
+def _unary(op):
+  def method(self):
+    results = map(op, self.items())
+    vector = pack(results)
+    return _list_to_stack(results) if vector is None else vector
+  return method
+
+
+def _list_to_stack(items):
+  stack = ()
+  for item in reversed(items):
+    stack = item, stack
+  return stack
+
+
+for _name, _op in (
+  ('add', operator.add),
+  ('sub', operator.sub),
+  ('mul', operator.mul),
+  ('div', operator.div),
+  ('truediv', operator.truediv),
+  ('floordiv', operator.floordiv),
+  ('mod', operator.mod),
+  ('pow', operator.pow),
+  ):
+  setattr(Vector, '__%s__' % (_name,), _arithmetic(_op))
+  setattr(Vector, '__r%s__' % (_name,), _arithmetic(_op, reflected=True))
+
+Vector.__neg__ = _unary(operator.neg)
+Vector.__pos__ = _unary(operator.pos)
+Vector.__abs__ = _unary(abs)
+
+del _name, _op
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright © 2017 Simon Forman
+#
+#    This file is part of Joypy.
+#
+#    Joypy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Joypy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Joypy.  If not see <http://www.gnu.org/licenses/>.
+#
+'''
+
+
+§ Vectorized map and step
+
+
+The map combinator in the library puts an infra and a first on the
+pending expression for every item, and step puts the quote and itself
+back for every item, so "[2 *] map" on a list of 100,000 numbers takes
+hundreds of thousands of steps of the evaluator.
+
+Most quotes given to map and step are just arithmetic: literals, the
+words made from Python operators (BinaryBuiltinWrapper and
+UnaryBuiltinWrapper), a few stack shuffles (dup, swap, over, pop and the
+like, and succ, pred and pm) and definitions made of those.  The
+versions of map and step in this module run such a quote symbolically
+once, with the translator (see translator.py), to get straight-line
+Python code for it, and compile that into one loop over the whole list:
+
+  [dup * 1 +] map  ->  for item in items:
+                         v1 = operator.mul(item, item)
+                         v2 = operator.add(v1, 1)
+                         append(v2)
+
+and for a fold like product ("1 swap [*] step") the stack is the state
+carried round the loop:
+
+  [*] step  ->  for item in items:
+                  (v1, v2) = stack
+                  v3 = operator.mul(v1, item)
+                  stack = (v3, v2)
+
+The code calls the very same Python functions as the words do, so the
+results (and errors) are the same as the reference versions'.  The
+result of mapping over a Vector (see utils/vector.py) is a Vector if the
+results will pack.  Anything else (a quote with a word that isn't
+arithmetic or a shuffle, a quote only known at runtime...) is left to
+the reference versions in the library, as are lists of fewer than
+MIN_ITEMS items, where compiling wouldn't pay.
+
+The compiled loops are cached on the quote (the object, not its text)
+and the version of the Dictionary (see linker.py) so redefining a word
+is seen right away.  Quotes run with a plain dict aren't cached.
+
+(The loops run over the items one at a time in Python rather than as
+NumPy array expressions, for the same reasons the Vectors aren't NumPy
+arrays: Joy's numbers are Python's.)  The iterations aren't seen by a
+viewer, and since they couldn't be counted against a Budget the
+reference versions are used inside budgeted_joy() (see budget.py.)
+
+  use_vectorized(dictionary)  # Put these versions in the dictionary.
+  use_vectorized(dictionary, False)  # Put the reference versions back.
+
+Exports:
+
+  MIN_ITEMS
+
+  SHUFFLES
+
+  vectorized_combinators
+
+  use_vectorized(dictionary, vectorized=True)
+
+'''
+from . import library
+from .library import (
+  FunctionWrapper,
+  dup,
+  dupd,
+  id_,
+  over,
+  pm,
+  pop,
+  popd,
+  popdd,
+  popop,
+  pred,
+  rolldown,
+  rollup,
+  succ,
+  swap,
+  tuck,
+  )
+from .budget import active_budget
+from .translator import (
+  Translation,
+  Translator,
+  Untranslatable,
+  Value,
+  code_of,
+  load,
+  )
+from .utils.lru import LRUCache
+from .utils.stack import iter_stack, list_to_stack
+from .utils.vector import Vector, pack
+
+
+# The functions of the SimpleFunctionWrappers a quote may use.
+SHUFFLES = frozenset((
+  dup, dupd, id_, over, pm, pop, popd, popdd, popop, pred, rolldown,
+  rollup, succ, swap, tuck,
+  ))
+
+# Lists shorter than this are left to the reference versions.
+MIN_ITEMS = 8
+
+
+_TEMPLATES = {
+
+  'map': '''\
+def loop(items, stack):
+  results = []
+  append = results.append
+  for item in items:
+%s
+    append(%s)
+  return results
+''',
+
+  'step': '''\
+def loop(items, stack):
+  for item in items:
+%s
+    stack = %s
+  return stack
+''',
+
+  }
+
+
+def _compile(quote, dictionary, kind):
+  '''
+  Return the function loop(items, stack) that does what map or step
+  (the kind) would do with the quote, or None if it can't be vectorized.
+  '''
+  translation = Translation()
+  item, stack = Value(translation, 'item'), Value(translation, 'stack')
+  stack.depth = 0
+  modules = set()
+  try:
+    result = Translator(dictionary, translation, modules, SHUFFLES).run(
+      (item, stack), quote)
+    if kind == 'map':
+      if not isinstance(result, tuple):
+        return None  # It took all of the stack.
+      result = result[0]
+    source = _TEMPLATES[kind] % (
+      '\n'.join('    ' + line for line in translation.lines) or '    pass',
+      code_of(result),
+      )
+  except Untranslatable:
+    return None
+  return load(source, modules, '<vectorized %s>' % (kind,))['loop']
+
+
+_compiled = LRUCache(max_items=1000)
+
+
+def _loop_for(quote, dictionary, kind):
+  version = getattr(dictionary, 'version', None)
+  if version is None:
+    return _compile(quote, dictionary, kind)
+  key = id(quote), version, kind
+  entry = _compiled.get(key)
+  if entry is None or entry[0] is not quote:  # The id was reused.
+    entry = quote, _compile(quote, dictionary, kind)
+    _compiled.put(key, entry, 0)
+  return entry[1]
+
+
+def _long_enough(aggregate):
+  if active_budget() is not None:
+    return False  # Let the reference versions count the steps.
+  if isinstance(aggregate, Vector):
+    return aggregate.size() >= MIN_ITEMS
+  for _ in xrange(MIN_ITEMS):
+    if not aggregate:
+      return False
+    _, aggregate = aggregate
+  return True
+
+
+def map_(S, expression, dictionary):
+  '''
+  Run the quoted program on TOS on the items in the list under it, push a
+  new list with the results (in place of the program and original list.
+  '''
+  (quote, (aggregate, stack)) = S
+  loop = _long_enough(aggregate) and _loop_for(quote, dictionary, 'map')
+  if not loop:
+    return library.map_(S, expression, dictionary)
+  results = loop(iter_stack(aggregate), stack)
+  vector = isinstance(aggregate, Vector) and pack(results)
+  return (vector or list_to_stack(results), stack), expression, dictionary
+
+
+def step(S, expression, dictionary):
+  '''
+  Run a quoted program on each item in a sequence.
+
+     ... [a b c] [Q] . step
+  ----------------------------------------
+               ... a Q b Q c Q .
+
+  '''
+  (quote, (aggregate, stack)) = S
+  loop = _long_enough(aggregate) and _loop_for(quote, dictionary, 'step')
+  if not loop:
+    return library.step(S, expression, dictionary)
+  return loop(iter_stack(aggregate), stack), expression, dictionary
+
+
+vectorized_combinators = (
+  FunctionWrapper(map_),
+  FunctionWrapper(step),
+  )
+
+
+def use_vectorized(dictionary, vectorized=True):
+  '''
+  Install the vectorized combinators in the dictionary, or if vectorized
+  is false restore the reference ones from the library.
+  '''
+  if vectorized:
+    dictionary.update((F.name, F) for F in vectorized_combinators)
+    return
+  dictionary.update(
+    (F.name, F)
+    for F in library.combinators
+    if F.name in ('map', 'step')
+    )
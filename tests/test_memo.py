@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+'''
+The memo combinator must never take a result cached for items or quotes
+that are == but of other types.
+'''
+import unittest
+from joy.joy import joy
+from joy.library import initialize
+from joy.memo import use_memo
+from joy.parser import text_to_expression
+from joy.utils.stack import stack_to_string
+
+
+class MemoKeyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dictionary = initialize()
+    use_memo(self.dictionary)
+
+  def run_joy(self, text):
+    stack, _, _ = joy((), text_to_expression(text), self.dictionary)
+    return stack_to_string(stack)
+
+  def test_word_is_not_string(self):
+    self.assertEqual(self.run_joy('5 1 ["dup"] memo'), "5 'dup'")
+    self.assertEqual(self.run_joy('5 1 [dup] memo'), '5 5')
+
+  def test_purity_is_not_shared_with_string(self):
+    self.assertEqual(self.run_joy('1 2 3 0 ["clear"] memo'), "1 2 3 'clear'")
+    self.assertRaises(ValueError, self.run_joy, '1 2 3 0 [clear] memo')
+
+  def test_int_is_not_float_inside_quotes(self):
+    self.assertEqual(self.run_joy('[1] 1 [first 3 *] memo'), '3')
+    self.assertEqual(self.run_joy('[1.0] 1 [first 3 *] memo'), '3.0')
+
+
+if __name__ == '__main__':
+  unittest.main()